@@ -0,0 +1,104 @@
+'''
+Stores registered Users in a single SQLite database in the users directory. Name, version and token timestamps are kept
+in their own columns, so listing accounts or checking versions never has to deserialize any credentials.
+'''
+
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import errors
+
+class AccountStore:
+    '''
+    Registered Users, indexed by name. Safe to use from several processes at once.
+    '''
+
+    def __init__(self, directory='users'):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        self.connection = sqlite3.connect(os.path.join(directory, 'accounts.db'), timeout=30, check_same_thread=False) ## wait for other processes' writes
+        self.lock = threading.Lock() ## Users are saved from refresh threads too
+        self.connection.execute('PRAGMA journal_mode=WAL') ## readers don't block the writer
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS accounts (
+                    name TEXT PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    registered_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    token_expires_at REAL,
+                    data BLOB NOT NULL
+                )
+            ''')
+        self.import_pickles()
+
+    def import_pickles(self):
+        '''
+        Adds Users registered before the store existed (users/*.pickle) that aren't in the store yet. The files are left in place.
+        '''
+        known = set(self.names())
+        for file in os.listdir(self.directory):
+            match = re.fullmatch(r'(.*)\.pickle', file)
+            if match is None or match.group(1) in known or not os.path.isfile(os.path.join(self.directory, file)):
+                continue
+            with open(os.path.join(self.directory, file), 'rb') as read:
+                account = pickle.load(read)
+            self.save(account)
+
+    def names(self):
+        '''
+        Returns the names of every registered User.
+        '''
+        return [row[0] for row in self.connection.execute('SELECT name FROM accounts ORDER BY name')]
+
+    def info(self, name=None):
+        '''
+        Returns the metadata of the User named NAME (or of every User) as a list of dictionaries, without loading any credentials.
+        '''
+        query = 'SELECT name, version, registered_at, updated_at, token_expires_at FROM accounts'
+        rows = self.connection.execute(query + ' ORDER BY name') if name is None else self.connection.execute(query + ' WHERE name = ?', (name,))
+        return [
+            {'name': row[0], 'version': row[1], 'registered_at': row[2], 'updated_at': row[3], 'token_expires_at': row[4]}
+            for row in rows
+        ]
+
+    def exists(self, name):
+        '''
+        Returns whether a User named NAME is registered.
+        '''
+        return self.connection.execute('SELECT 1 FROM accounts WHERE name = ?', (name,)).fetchone() is not None
+
+    def load(self, name, version):
+        '''
+        Returns the User named NAME. Raises InvalidRegisteredUser if there is none and OutdatedUser if it was registered with
+        a version other than VERSION; the version is checked before anything is deserialized.
+        '''
+        row = self.connection.execute('SELECT version FROM accounts WHERE name = ?', (name,)).fetchone()
+        if row is None: ## invalid user
+            raise errors.InvalidRegisteredUser()
+        if row[0] != version:
+            raise errors.OutdatedUser()
+        data = self.connection.execute('SELECT data FROM accounts WHERE name = ?', (name,)).fetchone()[0]
+        return pickle.loads(data)
+
+    def save(self, account):
+        '''
+        Adds ACCOUNT to the store, replacing any User with the same name.
+        '''
+        now = time.time()
+        credential_manager = getattr(account, 'credentials', None)
+        expires = [credential.expires_at for credential in credential_manager.credentials.values()] if credential_manager else []
+        with self.lock, self.connection:
+            self.connection.execute('''
+                INSERT INTO accounts (name, version, registered_at, updated_at, token_expires_at, data) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    version = excluded.version, updated_at = excluded.updated_at,
+                    token_expires_at = excluded.token_expires_at, data = excluded.data
+            ''', (account.get_name(), account.version, now, now, min(expires, default=None), pickle.dumps(account)))
+
+    def close(self):
+        self.connection.close()
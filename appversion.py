@@ -0,0 +1,117 @@
+'''
+Resolves the version of the Nintendo Switch Online app, which the login server expects in the X-ProductVersion header.
+The version is cached in memory and on disk so that the App Store only has to be asked once in a while.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+import errors
+import metrics
+
+ITUNES_APP_ID = 1234806557
+
+class VersionCache:
+    '''
+    Caches the NSO app version for TTL seconds. Once the cached value is stale, it is still served while a background thread
+    looks up the new version (stale-while-revalidate). If a lookup fails, the last known version is kept.
+    '''
+
+    def __init__(self, path='cache/nso_version.json', ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.version = None
+        self.fetched_at = 0
+        self.loaded = False ## whether the disk cache has been read yet
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        '''
+        Returns the NSO app version, looking it up only if nothing is cached at all.
+        '''
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            version, age = self.version, time.time() - self.fetched_at
+            if version is not None and age > self.ttl and not self.refreshing:
+                self.refreshing = True
+                threading.Thread(target=self.refresh, daemon=True).start()
+        if version is None: ## cold cache, nothing to serve while waiting
+            version = self.refresh()
+            if version is None:
+                raise errors.InvalidAppVersion()
+        return version
+
+    def refresh(self):
+        '''
+        Looks up the NSO app version from the App Store and stores it. Returns the last known version if the lookup fails.
+        '''
+        try:
+            version = fetch_version()
+        except Exception as e:
+            logging.error(f'Failed to look up the NSO app version ({e}), keeping {self.version}.')
+            with self.lock:
+                self.refreshing = False
+                self.fetched_at = time.time() - self.ttl + min(self.ttl, 600) ## retry in at most ten minutes instead of every call
+                return self.version
+
+        with self.lock:
+            self.version, self.fetched_at = version, time.time()
+            self.refreshing = False
+            self.save()
+        logging.info(f'NSO app version resolved to {version}.')
+        return version
+
+    def load(self):
+        '''
+        Reads the last known version from disk, if any.
+        '''
+        self.loaded = True
+        try:
+            with open(self.path) as read:
+                cached = json.load(read)
+            self.version, self.fetched_at = cached['version'], cached['fetched_at']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        '''
+        Writes the current version to disk. Failures are logged but not fatal since the memory cache still works.
+        '''
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as outfile:
+                json.dump({'version': self.version, 'fetched_at': self.fetched_at}, outfile)
+            os.replace(temp_path, self.path) ## atomic so concurrent processes never read half a file
+        except OSError as e:
+            logging.error(f'Failed to save the NSO app version cache: {e}')
+
+@metrics.count_failures('app_store')
+def fetch_version():
+    '''
+    Looks up the current NSO app version from the App Store.
+    '''
+    import itunes_app_scraper.scraper ## only needed when the cache is cold or stale
+    scraper = itunes_app_scraper.scraper.AppStoreScraper()
+    start = time.perf_counter()
+    nso_app_info = scraper.get_app_details(ITUNES_APP_ID, country='us')
+    metrics.observe('request_seconds', time.perf_counter() - start, endpoint='app_store')
+    metrics.inc('requests_total', endpoint='app_store', status='ok')
+    version = nso_app_info.get('version')
+    if not version:
+        raise ValueError('no version in App Store response')
+    return version
+
+cache = VersionCache()
+
+def get_version():
+    '''
+    Returns the NSO app version from the shared cache.
+    '''
+    return cache.get()
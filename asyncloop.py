@@ -0,0 +1,119 @@
+'''
+asyncio runner for the discord subcommand. Token refresh, friend polling and Discord updates run as independent tasks,
+so a slow response from Nintendo never holds up a Discord update and vice versa.
+'''
+
+import asyncio
+import backoff
+import credentials
+import time
+import logging
+import errors
+import metrics
+import scheduler
+
+REFRESH_INTERVAL = 60 ## seconds between credential expiry checks
+RECOVERABLE_ERRORS = (errors.ConnectionError, errors.InvalidAPIResponse, errors.InvalidAppVersion) ## retried with backoff
+
+async def refresh_task(main_user, interval):
+    '''
+    Renews MAIN_USER's credentials well before they expire, so polls never wait on a login (see refresher.py).
+    '''
+    failures = backoff.Backoff(base=5, cap=600)
+    while True:
+        try:
+            await main_user.refresh_login_async(credentials.PROACTIVE_MARGIN)
+        except Exception as e: ## the task must outlive any failure, polls keep using the current credentials meanwhile
+            delay = failures.next_delay()
+            logging.error(f'Refreshing the login failed ({e!r}). Retrying the refresh in {delay:.0f} seconds.')
+            await asyncio.sleep(delay)
+            continue
+        failures.reset()
+        await asyncio.sleep(interval)
+
+async def poll_task(main_user, displayed_user_name, latest, changed, discord_ready, poll_scheduler, recorder=None):
+    '''
+    Fetches the status of DISPLAYED_USER_NAME whenever POLL_SCHEDULER says so, stores it in LATEST and signals CHANGED.
+    Polling pauses while DISCORD_READY is cleared. Each status is also passed to RECORDER (a history.SessionRecorder), if any.
+    '''
+    failures = backoff.Backoff(base=5, cap=600)
+    next_poll = time.monotonic()
+    while True:
+        if not discord_ready.is_set():
+            await discord_ready.wait()
+            next_poll = time.monotonic()
+        tick_start = time.monotonic()
+        metrics.observe('poll_lag_seconds', max(0, tick_start - next_poll))
+        logging.info("Fetching user status...")
+        try:
+            displayed_user_status = await main_user.get_account_status_async(displayed_user_name)
+        except RECOVERABLE_ERRORS as e:
+            delay = failures.next_delay()
+            logging.error(f'{e} Retrying in {delay:.0f} seconds.')
+            next_poll = time.monotonic() + delay
+            await asyncio.sleep(delay)
+            continue
+        failures.reset()
+        if displayed_user_status is None: ## ensure that this display user really exists (either is self or comes from friends list)
+            logging.error(f"Failed to find the user {displayed_user_name}.")
+            raise errors.InvalidDisplayUser()
+        latest['status'] = displayed_user_status
+        if recorder is not None:
+            recorder.observe(displayed_user_status)
+        changed.set()
+        metrics.observe('poll_seconds', time.monotonic() - tick_start)
+        delay = poll_scheduler.next_delay(displayed_user_status)
+        next_poll = time.monotonic() + delay
+        await asyncio.sleep(delay)
+
+async def push_task(discord, latest, changed, discord_ready):
+    '''
+    Pushes the most recent status to Discord whenever a new one arrives. Statuses that arrive while an update is
+    still in flight are collapsed into the next one, and a status held back by Discord's rate limit is sent as soon
+    as the limit allows. If Discord goes away, DISCORD_READY is cleared until it is reconnected.
+    '''
+    while True:
+        try:
+            if not discord.connected:
+                discord_ready.clear()
+                print('Lost connection to Discord, waiting for it to come back...')
+                await asyncio.to_thread(discord.connect)
+                discord_ready.set()
+                await discord.flush_async() ## the status shown before the connection was lost
+            timeout = None if discord.pending is None else discord.seconds_until_allowed()
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                await discord.flush_async()
+                continue
+            changed.clear()
+            await discord.display_async(latest['status'])
+        except errors.DiscordError:
+            continue ## reconnects at the top of the loop
+
+async def run_tasks(main_user, displayed_user_name, discord, poll_scheduler=None, refresh_interval=REFRESH_INTERVAL, recorder=None):
+    '''
+    Runs the three tasks until one of them fails, then cancels the others and re-raises the error.
+    '''
+    if poll_scheduler is None:
+        poll_scheduler = scheduler.PollScheduler()
+    latest = {'status': None}
+    changed = asyncio.Event()
+    discord_ready = asyncio.Event()
+    discord_ready.set() ## main.discord connects before starting the tasks
+    tasks = [
+        asyncio.create_task(refresh_task(main_user, refresh_interval)),
+        asyncio.create_task(poll_task(main_user, displayed_user_name, latest, changed, discord_ready, poll_scheduler, recorder)),
+        asyncio.create_task(push_task(discord, latest, changed, discord_ready))
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def run(main_user, displayed_user_name, discord, poll_scheduler=None, refresh_interval=REFRESH_INTERVAL, recorder=None):
+    '''
+    Blocking entry point used by main.discord.
+    '''
+    asyncio.run(run_tasks(main_user, displayed_user_name, discord, poll_scheduler, refresh_interval, recorder))
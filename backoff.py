@@ -0,0 +1,82 @@
+'''
+Exponential backoff and circuit breaking, used to recover from Discord being closed and from failing Nintendo requests
+without busy-looping or giving up.
+'''
+
+import random
+import threading
+import time
+
+class Backoff:
+    '''
+    Delays that start at BASE seconds and grow by FACTOR after every failure, up to CAP. Each delay is randomly
+    shortened by up to JITTER (a fraction) so that several processes don't retry in lockstep.
+    '''
+
+    def __init__(self, base=1, cap=300, factor=2, jitter=0.5):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        '''
+        Returns how long to wait before the next attempt, and counts this failure.
+        '''
+        delay = min(self.cap, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - random.uniform(0, self.jitter))
+
+    def reset(self):
+        '''
+        Starts over from BASE after a success.
+        '''
+        self.attempts = 0
+
+class CircuitBreaker:
+    '''
+    Stops calls to something that keeps failing. After FAILURE_THRESHOLD failures in a row the circuit opens and allow()
+    returns False for COOLDOWN seconds; after that a single trial call is let through (half-open), and its outcome either
+    closes the circuit again or re-opens it.
+    '''
+
+    def __init__(self, failure_threshold=5, cooldown=60):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Returns whether a call may be made now.
+        '''
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial_running:
+                return False
+            self.trial_running = True ## half-open: let one call find out whether it works again
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures, self.opened_at, self.trial_running = 0, None, False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+    def seconds_until_retry(self):
+        '''
+        Returns how long until a call will be let through again (0 if the circuit is closed).
+        '''
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            return max(0, self.opened_at + self.cooldown - time.monotonic())
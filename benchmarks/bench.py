@@ -0,0 +1,145 @@
+'''
+Offline benchmarks for DiscordRPC4Switch. Runs User and Discord against the local stand-ins in fakeservices.py and reports
+login time, per-poll latency, requests per tick, Discord update latency and memory use over a long run.
+
+Usage: python benchmarks/bench.py [--polls 200] [--friends 300] [--latency 0.05] [--discord-latency 0.001] [--json]
+'''
+
+import argparse
+import json
+import os
+import pickle
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) ## the project's modules live one level up
+
+import fakeservices
+import appversion
+import ftoken
+import gameclock
+import transport
+import user
+
+def point_at(fake):
+    '''
+    Sends every request User and appversion make to FAKE instead of the real services.
+    '''
+    user.User.token_url = fake.url + '/connect/1.0.0/api/token'
+    user.User.gen_info_url = fake.url + '/2.0.0/users/me'
+    user.User.login_url = fake.url + '/v3/Account/Login'
+    user.User.friends_list_url = fake.url + '/v3/Friend/List'
+    ftoken.configure([fake.url + '/f'])
+    directory = tempfile.mkdtemp(prefix='bench-')
+    appversion.cache = appversion.VersionCache(os.path.join(directory, 'nso_version.json'))
+    gameclock._clock = gameclock.GameClock(os.path.join(directory, 'game_starts.json'))
+    appversion.fetch_version = lambda: transport.get_session().get(fake.url + '/lookup', timeout=transport.TIMEOUT).json()['results'][0]['version']
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def bench_login(fake):
+    '''
+    Times a cold login (nothing cached) and a warm one (a saved User with valid tokens, as after a restart).
+    Returns the results and the warm User.
+    '''
+    results = {}
+    cold_user = user.User('bench-session-token')
+    before = fake.total_requests()
+    results['cold_login_s'], _ = timed(cold_user.login)
+    results['cold_login_requests'] = fake.total_requests() - before
+    results['cold_login_steps_ms'] = {step: round(seconds * 1000, 1) for step, seconds in cold_user.login_timings.items()}
+
+    warm_user = pickle.loads(pickle.dumps(cold_user)) ## what a restart loads from the account store
+    before = fake.total_requests()
+    results['warm_login_s'], _ = timed(warm_user.login)
+    results['warm_login_requests'] = fake.total_requests() - before
+    return results, warm_user
+
+def bench_polls(fake, bench_user, polls, discord=None):
+    '''
+    Runs POLLS status polls for a friend whose game changes every 20 polls, and measures latency, requests and memory.
+    '''
+    latencies, requests = [], []
+    tracemalloc.start()
+    memory = []
+    for i in range(polls):
+        if i % 20 == 0:
+            fake.set_presence(0, 'ONLINE', f'Game{i // 20}')
+        before = fake.total_requests()
+        start = time.perf_counter()
+        status = bench_user.get_account_status('Friend0')
+        if discord is not None:
+            discord.display(status)
+        latencies.append(time.perf_counter() - start)
+        requests.append(fake.total_requests() - before)
+        memory.append(tracemalloc.get_traced_memory()[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    half = len(memory) // 2
+    return {
+        'polls': polls,
+        'poll_mean_ms': statistics.mean(latencies) * 1000,
+        'poll_p50_ms': percentile(latencies, 0.5) * 1000,
+        'poll_p95_ms': percentile(latencies, 0.95) * 1000,
+        'poll_max_ms': max(latencies) * 1000,
+        'requests_per_tick': statistics.mean(requests),
+        'memory_current_kib': memory[-1] / 1024,
+        'memory_peak_kib': peak / 1024,
+        'memory_growth_kib': (statistics.mean(memory[half:]) - statistics.mean(memory[:half])) / 1024 if half else 0
+    }
+
+def make_discord(args):
+    '''
+    Returns a Discord connected to a FakeDiscord, or None if pypresence isn't installed.
+    '''
+    try:
+        import discordrpc
+    except ImportError:
+        return None, None
+    fake_discord = fakeservices.FakeDiscord(args.discord_latency).start()
+    discord = discordrpc.Discord(False)
+    discord.connect()
+    return discord, fake_discord
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks against local stand-ins for Nintendo, imink, the App Store and Discord.')
+    parser.add_argument('--polls', type=int, default=200, help='Number of status polls to run.')
+    parser.add_argument('--friends', type=int, default=300, help='Size of the served friend list.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency added to every HTTP response.')
+    parser.add_argument('--route-latency', action='append', default=[], metavar='PATH=SECONDS', help='Latency for one route, e.g. /f=0.5. Can be repeated.')
+    parser.add_argument('--discord-latency', type=float, default=0.0, help='Seconds of latency added to every Discord IPC reply.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    route_latency = {route: float(seconds) for route, seconds in (item.split('=', 1) for item in args.route_latency)}
+    fake = fakeservices.FakeNintendo(route_latency, args.latency, args.friends).start()
+    point_at(fake)
+
+    results, warm_user = bench_login(fake)
+
+    discord, fake_discord = make_discord(args)
+    results.update(bench_polls(fake, warm_user, args.polls, discord))
+    if fake_discord is not None:
+        results['discord_updates'] = fake_discord.updates
+        fake_discord.stop()
+    results['requests_by_route'] = dict(fake.counts)
+    fake.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, value in results.items():
+            print(f'{name:24} {value:.3f}' if isinstance(value, float) else f'{name:24} {value}')
+
+if __name__ == '__main__':
+    main()
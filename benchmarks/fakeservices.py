@@ -0,0 +1,179 @@
+'''
+Local stand-ins for the services DiscordRPC4Switch talks to: one HTTP server that replays recorded Nintendo, imink and
+App Store responses, and a Discord IPC socket. Both count what they receive and can inject latency.
+'''
+
+import copy
+import http.server
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+RESPONSES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'responses.json')
+
+class FakeNintendo:
+    '''
+    HTTP server replaying the responses in responses.json. LATENCY maps a route (e.g. '/v3/Friend/List') to the seconds
+    to wait before answering; DEFAULT_LATENCY applies to every other route. FRIENDS is the size of the friend list served.
+    '''
+
+    routes = {
+        '/connect/1.0.0/api/token': 'token',
+        '/2.0.0/users/me': 'gen_info',
+        '/v3/Account/Login': 'login',
+        '/v3/Friend/List': 'friends_list',
+        '/f': 'imink',
+        '/lookup': 'app_store'
+    }
+
+    def __init__(self, latency=None, default_latency=0, friends=50):
+        with open(RESPONSES_PATH) as read:
+            self.responses = json.load(read)
+        self.latency = latency or {}
+        self.default_latency = default_latency
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.responses['friends_list']['result']['friends'] = make_friends(self.responses['friends_list']['result']['friends'][0], friends, self.url)
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' ## keep-alive, like the real services
+            disable_nagle_algorithm = True ## headers and body are separate writes, don't let delayed ACKs stall the second one
+
+            def handle_route(self):
+                path = self.path.split('?')[0]
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                name = fake.routes.get(path)
+                route = '/images' if path.startswith('/images/') else path
+                with fake.lock:
+                    fake.counts[route] = fake.counts.get(route, 0) + 1
+                time.sleep(fake.latency.get(route, fake.default_latency))
+                if route == '/images': ## game art and Mii icons
+                    body, content_type, status = b'\x89PNG' + bytes(1024), 'image/png', 200
+                else:
+                    body, content_type, status = json.dumps(fake.responses[name] if name else {'error': 'not found'}).encode(), 'application/json', 200 if name else 404
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = handle_route
+            do_POST = handle_route
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def total_requests(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+    def set_presence(self, index, state, game=None):
+        '''
+        Changes the presence of friend INDEX in the served friend list.
+        '''
+        presence = self.responses['friends_list']['result']['friends'][index]['presence']
+        presence['state'], presence['updatedAt'] = state, int(time.time())
+        presence['game'] = {} if game is None else {'name': game, 'imageUri': f'{self.url}/images/game/{game}.jpg'}
+
+def make_friends(template, count, url):
+    '''
+    Returns COUNT friends built from the recorded TEMPLATE friend, each with a distinct id, nsaId and name, and images
+    served from URL.
+    '''
+    friends = []
+    for i in range(count):
+        friend = copy.deepcopy(template)
+        friend['id'], friend['nsaId'], friend['name'] = i, f'{i:016x}', f'Friend{i}'
+        friend['imageUri'] = f'{url}/images/mii/{i}.png'
+        friend['presence']['game']['imageUri'] = f'{url}/images/game/0.jpg'
+        friends.append(friend)
+    return friends
+
+class FakeDiscord:
+    '''
+    Discord IPC socket answering the handshake and SET_ACTIVITY commands the way the Discord client does.
+    It listens in its own temporary directory, which must be used as XDG_RUNTIME_DIR before pypresence connects.
+    '''
+
+    def __init__(self, latency=0, pipe=0):
+        self.latency = latency
+        self.directory = tempfile.mkdtemp(prefix='fake-discord-')
+        self.path = os.path.join(self.directory, f'discord-ipc-{pipe}')
+        self.updates = 0
+        self.activities = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+
+    def start(self):
+        os.environ['XDG_RUNTIME_DIR'] = self.directory
+        threading.Thread(target=self.serve, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.close()
+        try:
+            os.remove(self.path)
+            os.rmdir(self.directory)
+        except OSError:
+            pass
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError: ## stopped
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        with connection:
+            while True:
+                header = receive_exactly(connection, 8)
+                if header is None:
+                    return
+                op, length = struct.unpack('<II', header)
+                payload = json.loads(receive_exactly(connection, length) or b'{}')
+                time.sleep(self.latency)
+                if op == 0: ## handshake
+                    reply = {'cmd': 'DISPATCH', 'evt': 'READY', 'nonce': None, 'data': {'v': 1, 'config': {}, 'user': {'id': '0', 'username': 'bench'}}}
+                elif op == 2: ## close
+                    return
+                else:
+                    if payload.get('cmd') == 'SET_ACTIVITY':
+                        self.updates += 1
+                        self.activities.append(payload.get('args', {}).get('activity'))
+                    reply = {'cmd': payload.get('cmd'), 'evt': None, 'nonce': payload.get('nonce'), 'data': payload.get('args', {}).get('activity')}
+                body = json.dumps(reply).encode()
+                connection.sendall(struct.pack('<II', 1, len(body)) + body)
+
+def receive_exactly(connection, length):
+    data = b''
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
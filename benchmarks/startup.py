@@ -0,0 +1,75 @@
+'''
+Startup benchmark for the command line: runs quick subcommands of main.py in fresh interpreters and reports how long they
+take, along with the slowest imports of each, so that heavy modules creeping back into startup are easy to spot.
+
+Usage: python benchmarks/startup.py [--runs 10] [--json]
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+COMMANDS = {
+    'help': ['--help'],
+    'accounts': ['accounts'],
+    'history': ['history']
+}
+
+def run(arguments, directory, importtime=False):
+    '''
+    Runs main.py with ARGUMENTS from DIRECTORY and returns the wall time and stderr.
+    '''
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + [MAIN_PATH] + arguments
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    return time.perf_counter() - start, completed.stderr
+
+def slowest_imports(importtime_output, count=5):
+    '''
+    Returns the COUNT top-level imports with the highest cumulative time (in ms) from -X importtime output.
+    '''
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '): ## only imports made by main.py itself, not their dependencies
+            imports.append((name.strip(), int(cumulative) / 1000))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:count]
+
+def timed_python():
+    '''
+    Returns the time an empty interpreter takes to start, the floor for every subcommand.
+    '''
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Times CLI startup for quick subcommands.')
+    parser.add_argument('--runs', type=int, default=10, help='Runs per subcommand.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-startup-') ## empty users directory, nothing registered
+    run(['accounts'], directory) ## warms the bytecode cache and creates the account store
+    results = {'python_s': statistics.median(timed_python() for _ in range(args.runs))}
+    for name, arguments in COMMANDS.items():
+        times = [run(arguments, directory)[0] for _ in range(args.runs)]
+        results[f'{name}_median_s'] = statistics.median(times)
+        results[f'{name}_slowest_imports_ms'] = dict(slowest_imports(run(arguments, directory, importtime=True)[1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, value in results.items():
+            print(f'{name:32} {value:.3f}' if isinstance(value, float) else f'{name:32} {value}')
+
+if __name__ == '__main__':
+    main()
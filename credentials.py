@@ -0,0 +1,64 @@
+'''
+Keeps track of the tokens a User logs in with and when each of them expires, so that they are only renewed when needed.
+'''
+
+import time
+
+REFRESH_MARGIN = 120 ## renew a credential this many seconds before it actually expires
+PROACTIVE_MARGIN = 600 ## the background refresher starts this much earlier, so REFRESH_MARGIN is only a fallback
+
+class Credential:
+    '''
+    A single token together with the time at which it stops being valid.
+    '''
+
+    def __init__(self, value, expires_in, issued_at=None):
+        self.value = value
+        self.issued_at = time.time() if issued_at is None else issued_at
+        self.expires_at = self.issued_at + expires_in
+
+    def seconds_left(self):
+        '''
+        Returns how many seconds this credential is still valid for.
+        '''
+        return self.expires_at - time.time()
+
+    def expires_soon(self, margin=REFRESH_MARGIN):
+        '''
+        Returns whether this credential is expired or will be within MARGIN seconds.
+        '''
+        return self.seconds_left() <= margin
+
+class CredentialManager:
+    '''
+    Stores the User's credentials by name. A credential that was never stored counts as expired.
+    '''
+
+    def __init__(self):
+        self.credentials = {}
+
+    def set(self, name, value, expires_in):
+        '''
+        Stores VALUE under NAME, valid for EXPIRES_IN seconds from now.
+        '''
+        self.credentials[name] = Credential(value, expires_in)
+
+    def get(self, name):
+        '''
+        Returns the value stored under NAME, or None if there is none.
+        '''
+        credential = self.credentials.get(name)
+        return None if credential is None else credential.value
+
+    def expires_soon(self, name, margin=REFRESH_MARGIN):
+        '''
+        Returns whether the credential NAME needs to be renewed.
+        '''
+        credential = self.credentials.get(name)
+        return credential is None or credential.expires_soon(margin)
+
+    def invalidate(self, name):
+        '''
+        Forgets the credential NAME so that it is renewed on next use.
+        '''
+        self.credentials.pop(name, None)
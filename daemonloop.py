@@ -0,0 +1,131 @@
+'''
+Daemon mode: shares the status of many (main user, displayed user, Discord client) targets from one process.
+Each main user is logged in once and its friend list is fetched once per tick, then fanned out to all of its targets.
+'''
+
+import json
+import logging
+import time
+import backoff
+import discordrpc
+import errors
+import history
+import metrics
+import profiling
+import refresher
+import scheduler
+
+class Target:
+    '''
+    One displayed user shown on one Discord client.
+    '''
+
+    def __init__(self, main_user_name, displayed_user_name, discord, poll_scheduler):
+        self.main_user_name = main_user_name
+        self.displayed_user_name = displayed_user_name
+        self.discord = discord
+        self.scheduler = poll_scheduler
+
+def load_config(path):
+    '''
+    Reads the daemon config at PATH and returns its targets as a list of dictionaries. The format is:
+    {
+        'targets': [
+            {'main_user': *registered user*, 'displayed_user': *friend name, default main_user*, 'client_id': *optional*, 'pipe': *optional*}
+        ]
+    }
+    '''
+    try:
+        with open(path) as read:
+            config = json.load(read)
+        targets = config['targets']
+        for target in targets:
+            target['main_user'] ## every target needs a main user
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.error(f'Failed to read daemon config {path}: {e!r}')
+        raise errors.InvalidConfig() from None
+    if len(targets) == 0:
+        logging.error(f'Daemon config {path} has no targets.')
+        raise errors.InvalidConfig()
+    return targets
+
+def try_reconnect(target):
+    '''
+    Tries to reconnect TARGET to Discord if its backoff allows it. Returns whether it is connected.
+    '''
+    if time.monotonic() < target.discord.retry_at:
+        return False
+    return target.discord.try_connect()
+
+def run(target_configs, get_user, log=False, make_scheduler=scheduler.PollScheduler, save_user=None, history_store=None, profiler=None):
+    '''
+    Logs in every main user in TARGET_CONFIGS once (loaded with GET_USER, and saved with SAVE_USER whenever its tokens are renewed), connects every target to Discord
+    and then keeps all targets updated. Each target gets its own scheduler from MAKE_SCHEDULER, and a main user's
+    friend list is fetched as soon as any of its targets is due. An account that fails to log in, or a displayed user
+    missing from the friend list, is retried later without holding up the other accounts and targets. Play sessions of every displayed user are recorded in
+    HISTORY_STORE, if given. Ticks are profiled with PROFILER (a profiling.Profiler), if given.
+    '''
+    profiler = profiling.Profiler() if profiler is None else profiler ## does nothing until asked to profile
+    main_users = {}
+    for target_config in target_configs:
+        main_user_name = target_config['main_user']
+        if main_user_name not in main_users:
+            main_users[main_user_name] = get_user(main_user_name)
+            main_users[main_user_name].on_login = save_user
+            main_users[main_user_name].toggle_log(log)
+
+    targets_by_user = {main_user_name: [] for main_user_name in main_users}
+    recorders = {main_user_name: history.SessionRecorder(history_store, main_user_name) for main_user_name in main_users} if history_store else {}
+    for target_config in target_configs:
+        discord = discordrpc.Discord(log, target_config.get('client_id', discordrpc.CLIENT_ID), target_config.get('pipe'))
+        discord.try_connect() ## a target whose Discord isn't open yet is retried from the loop, without holding up the others
+        displayed_user_name = target_config.get('displayed_user') or target_config['main_user']
+        targets_by_user[target_config['main_user']].append(Target(target_config['main_user'], displayed_user_name, discord, make_scheduler()))
+
+    print(f'Displaying status for {len(target_configs)} targets from {len(main_users)} accounts. To exit, press CTRL+C.')
+
+    next_poll = {main_user_name: 0 for main_user_name in main_users}
+    failures = {main_user_name: backoff.Backoff(base=5, cap=600) for main_user_name in main_users}
+    logged_in = set() ## logins happen in the loop, so a failing account is retried with its backoff like a failing poll
+    while True:
+        time.sleep(max(0, min(next_poll.values()) - time.time()))
+        with profiler.tick(): ## one wake-up of the loop, covering every account that was due
+            for main_user_name, main_user in main_users.items():
+                if next_poll[main_user_name] > time.time():
+                    continue
+                targets = [target for target in targets_by_user[main_user_name] if target.discord.connected or try_reconnect(target)]
+                if len(targets) == 0: ## no Discord to show anything on, so don't poll Nintendo either
+                    next_poll[main_user_name] = time.time() + min(target.discord.retry_at - time.monotonic() for target in targets_by_user[main_user_name])
+                    continue
+                tick_start = time.time()
+                metrics.observe('poll_lag_seconds', tick_start - next_poll[main_user_name] if next_poll[main_user_name] else 0)
+                delays = []
+                try:
+                    if main_user_name not in logged_in:
+                        main_user.login()
+                        logged_in.add(main_user_name)
+                        refresher.TokenRefresher(main_user).start() ## renews the tokens ahead of expiry, so ticks never wait on a login
+                    main_user.refresh_login() ## fallback if the background refresh kept failing, otherwise does nothing
+                    logging.info(f"Fetching statuses for {main_user_name}...")
+                    main_user.get_all_status() ## one fetch shared by every target of this account
+                except (errors.ConnectionError, errors.InvalidAPIResponse, errors.InvalidAppVersion) as e:
+                    delay = failures[main_user_name].next_delay()
+                    logging.error(f'{e} Retrying {main_user_name} in {delay:.0f} seconds.')
+                    next_poll[main_user_name] = time.time() + delay
+                    continue
+                failures[main_user_name].reset()
+                for target in targets:
+                    displayed_user_status = main_user.get_account_status(target.displayed_user_name, fetch=False)
+                    if displayed_user_status is None: ## e.g. a renamed or removed friend, the other targets keep going
+                        logging.error(f"Failed to find the user {target.displayed_user_name}.")
+                        delays.append(target.scheduler.max_interval)
+                        continue
+                    if main_user_name in recorders:
+                        recorders[main_user_name].observe(displayed_user_status)
+                    try:
+                        target.discord.display(displayed_user_status)
+                    except errors.DiscordError:
+                        logging.error(f'Lost connection to Discord for {target.displayed_user_name}, reconnecting in the background.')
+                    delays.append(target.scheduler.next_delay(displayed_user_status))
+                metrics.observe('poll_seconds', time.time() - tick_start)
+                next_poll[main_user_name] = time.time() + min(delays)
@@ -2,42 +2,175 @@
 Communication with Discord, updating User status.
 '''
 
+import asyncio
+import backoff
+import collections
 import pypresence
 import errors
+import gameclock
+import metrics
 import logging
+import time
+
+CLIENT_ID = '1117366813257383966'
+RATE_LIMIT_UPDATES = 5 ## Discord accepts at most this many activity updates...
+RATE_LIMIT_WINDOW = 20 ## ...per this many seconds
 
 class Discord():
-    def __init__(self, log):
-        self.client = pypresence.Presence('1117366813257383966')
+    def __init__(self, log, client_id=CLIENT_ID, pipe=None):
+        self.client_id, self.pipe = client_id, pipe ## PIPE selects a Discord instance when several are running
+        self.client = None
+        self.connected = False
+        self.backoff = backoff.Backoff(base=2, cap=60) ## retry slowly while Discord is closed instead of spinning
+        self.retry_at = 0
+        self.logging = log
+        self.last_payload = None ## last presence actually sent, identical updates are skipped
+        self.pending = None ## newest presence held back by the rate limit, replaced by any newer one
+        self.sent_times = collections.deque(maxlen=RATE_LIMIT_UPDATES)
 
     def set_user(self, user_name):
         self.user_name = user_name
     
     def connect(self):
-        while True:
-            try:
-                logging.info('Attempting to establish connection to Discord.')
-                self.client.connect()
-            except:
-                logging.error("Couldn't find an active Discord instance.")
+        '''
+        Blocks until a connection to Discord is established, retrying with exponential backoff.
+        '''
+        warned = False
+        while not self.try_connect():
+            if not warned:
                 print('No active Discord instance found. Please make sure Discord is open.')
-                continue
-            else:
-                logging.info('Connection to Discord established.')
-                break            
+                warned = True
+            time.sleep(max(0, self.retry_at - time.monotonic()))
+
+    def try_connect(self):
+        '''
+        Makes a single attempt to connect to Discord and returns whether it worked. After a failure, retry_at is set to
+        the earliest time another attempt should be made.
+        '''
+        try:
+            logging.info('Attempting to establish connection to Discord.')
+            self.client = pypresence.Presence(self.client_id, pipe=self.pipe) ## a closed client can't be reused
+            self.client.connect()
+        except Exception as e:
+            logging.error(f"Couldn't find an active Discord instance ({type(e).__name__}).")
+            self.retry_at = time.monotonic() + self.backoff.next_delay()
+            return False
+        logging.info('Connection to Discord established.')
+        self.connected = True
+        self.backoff.reset()
+        self.last_payload = None ## a new connection starts without any presence, so the next one has to be sent
+        return True
+
+    def disconnect(self):
+        '''
+        Marks the connection as lost so that it is re-established, and keeps the last presence pending to resend it.
+        '''
+        if self.pending is None:
+            self.pending = self.last_payload
+        self.connected = False
+        self.last_payload = None
+        self.retry_at = time.monotonic() + self.backoff.next_delay()
+        try:
+            self.client.close()
+        except Exception:
+            pass
     
     def update(self, large_image, large_text, small_text, small_image, status, start=None):
+        '''
+        Sets the presence shown on Discord. Nothing is sent if it is identical to the last one sent, and if the rate limit
+        has been reached it is held back until flush is called (only the newest held-back presence is kept).
+        Returns whether the presence was sent.
+        '''
+        payload = {
+            'large_image': large_image,
+            'large_text': large_text,
+            'small_text': small_text,
+            'small_image': small_image,
+            'details': status,
+            'start': start
+        }
+        if payload == self.last_payload:
+            self.pending = None ## a newer update made the held-back one obsolete
+            metrics.inc('discord_updates_total', result='unchanged')
+            return False
+        self.pending = payload
+        return self.flush()
+
+    @metrics.count_failures('discord_update')
+    def flush(self):
+        '''
+        Sends the held-back presence, if any, once the rate limit allows it. Returns whether it was sent.
+        '''
+        if self.pending is None:
+            return False
+        if self.seconds_until_allowed() > 0:
+            logging.info(f"Rate limited, holding back status: {self.pending['details']}")
+            metrics.inc('discord_updates_total', result='rate_limited')
+            return False
+        if not self.connected:
+            raise errors.DiscordError()
         try:
-            self.client.update(
-                large_image=large_image,
-                large_text=large_text,
-                small_text=small_text,
-                small_image=small_image,
-                details=status,
-                start=start
-            )
-            logging.info(f'Status: {status}')
-        except pypresence.exceptions.InvalidID:
+            self.client.update(**self.pending)
+            logging.info(f"Status: {self.pending['details']}")
+        except (pypresence.exceptions.PyPresenceException, OSError, RuntimeError):
             if self.logging:
                 logging.error("Couldn't find active Discord instance.")
-            raise errors.DiscordError() from None
\ No newline at end of file
+            self.disconnect()
+            raise errors.DiscordError() from None
+        metrics.inc('discord_updates_total', result='sent')
+        self.sent_times.append(time.monotonic())
+        self.last_payload, self.pending = self.pending, None
+        return True
+
+    def seconds_until_allowed(self):
+        '''
+        Returns how long until another update fits within Discord's rate limit (0 if one can be sent now).
+        '''
+        if len(self.sent_times) < RATE_LIMIT_UPDATES:
+            return 0
+        return max(0, self.sent_times[0] + RATE_LIMIT_WINDOW - time.monotonic())
+
+    def display(self, displayed_user_status):
+        '''
+        Shows DISPLAYED_USER_STATUS (a friend dictionary as returned by User.get_account_status) on Discord.
+        Unchanged statuses are not sent again (see update).
+        '''
+        self.flush() ## anything held back by the rate limit goes out first
+        user_state = displayed_user_status['presence']['state']
+        mii = displayed_user_status['imageUri']
+
+        start = gameclock.get_clock().start_of(displayed_user_status['nsaId'], displayed_user_status['presence']) ## from Nintendo's updatedAt, kept across restarts
+
+        if user_state == 'ONLINE':
+            game = displayed_user_status['presence']['game']['name']
+            gameAsset = displayed_user_status['presence']['game']['imageUri']
+
+            ## update the client
+            self.update(
+                large_image=gameAsset,
+                large_text=game,
+                small_image=mii,
+                small_text=displayed_user_status['name'],
+                status=f"Playing {game}",
+                start=start
+            )
+        elif user_state == 'INACTIVE':
+            self.update(
+                large_image='switch',
+                large_text='Home Screen',
+                small_image=mii,
+                small_text=displayed_user_status['name'],
+                status="Online"
+            )
+
+    async def display_async(self, displayed_user_status):
+        '''
+        Same as display, but runs the blocking IPC write in a worker thread so the event loop stays free.
+        '''
+        await asyncio.to_thread(self.display, displayed_user_status)
+
+    async def flush_async(self):
+        '''
+        Same as flush, but awaitable.
+        '''
+        return await asyncio.to_thread(self.flush)
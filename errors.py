@@ -44,6 +44,20 @@ class InvalidAPIResponse(Exception):
     def __str__(self):
         return self.message
 
+class InvalidAppVersion(Exception):
+    def __init__(self):
+        self.message = 'Could not determine the Nintendo Switch Online app version. Please check your internet connection and try again.'
+
+    def __str__(self):
+        return self.message
+
+class InvalidConfig(Exception):
+    def __init__(self):
+        self.message = 'The daemon config file is invalid. Refer to log for details (if toggled).'
+
+    def __str__(self):
+        return self.message
+
 class OutdatedUser(Exception):
     def __init__(self):
         self.message = 'This user is on an older version. Please try registering this user again.'
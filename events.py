@@ -0,0 +1,128 @@
+'''
+Presence change events. Consecutive friend list snapshots are compared and only what changed is reported, so consumers
+don't have to re-process (or keep their own copy of) the whole friend list every poll.
+'''
+
+import logging
+
+class PresenceEvent:
+    '''
+    Something changed about FRIEND (the friend's record, which keeps being updated by later polls). PREVIOUS is the
+    (state, game, name, imageUri) seen before.
+    '''
+
+    def __init__(self, friend, previous):
+        self.friend = friend
+        self.previous = previous
+
+    @property
+    def nsa_id(self):
+        return self.friend['nsaId']
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.friend['name']!r})"
+
+class WentOnline(PresenceEvent):
+    '''The friend came online (ONLINE or INACTIVE after being OFFLINE).'''
+
+class WentOffline(PresenceEvent):
+    '''The friend went OFFLINE.'''
+
+class StateChanged(PresenceEvent):
+    '''The friend switched between ONLINE and INACTIVE (e.g. closed a game and went back to the home screen).'''
+
+class GameChanged(PresenceEvent):
+    '''The friend started a different game (also emitted after WentOnline if they came online in a game).'''
+
+class NameChanged(PresenceEvent):
+    '''The friend changed their display name.'''
+
+class IconChanged(PresenceEvent):
+    '''The friend changed their Mii/icon.'''
+
+def summarize(friend):
+    '''
+    Returns the parts of FRIEND that events are based on.
+    '''
+    presence = friend['presence']
+    return presence['state'], (presence.get('game') or {}).get('name'), friend['name'], friend['imageUri']
+
+def diff(previous, friend):
+    '''
+    Returns the events describing how FRIEND changed since PREVIOUS (a summarize tuple).
+    '''
+    current = summarize(friend)
+    if current == previous:
+        return []
+    (old_state, old_game, old_name, old_icon), (state, game, name, icon) = previous, current
+    events = []
+    if old_state == 'OFFLINE' and state != 'OFFLINE':
+        events.append(WentOnline(friend, previous))
+    elif old_state != 'OFFLINE' and state == 'OFFLINE':
+        events.append(WentOffline(friend, previous))
+    elif old_state != state:
+        events.append(StateChanged(friend, previous))
+    if game != old_game and game is not None:
+        events.append(GameChanged(friend, previous))
+    if name != old_name:
+        events.append(NameChanged(friend, previous))
+    if icon != old_icon:
+        events.append(IconChanged(friend, previous))
+    return events
+
+class PresenceStream:
+    '''
+    Compares each friend list snapshot with the previous one and passes the resulting events to subscribed callbacks.
+    The first snapshot only sets the baseline.
+    '''
+
+    def __init__(self):
+        self.snapshot = None ## nsaId -> summarize tuple
+        self.subscribers = [] ## (callback, keys or None)
+
+    def subscribe(self, callback, keys=None):
+        '''
+        Calls CALLBACK(event) for every event, or only for the friends in KEYS (names, nsaIds or ids, resolved with
+        resolve). Returns a function that unsubscribes again.
+        '''
+        subscriber = (callback, None if keys is None else list(keys))
+        self.subscribers.append(subscriber)
+        return lambda: self.subscribers.remove(subscriber)
+
+    def update(self, friends, resolve=None):
+        '''
+        Diffs FRIENDS against the previous snapshot, dispatches the events and returns them. RESOLVE maps a subscriber key
+        to a friend dictionary (e.g. FriendIndex.find).
+        '''
+        if self.snapshot is None:
+            self.snapshot = {friend['nsaId']: summarize(friend) for friend in friends}
+            return []
+        events = []
+        seen = set()
+        for friend in friends:
+            seen.add(friend['nsaId'])
+            old = self.snapshot.get(friend['nsaId'])
+            current = summarize(friend)
+            if current != old: ## the snapshot is kept in place, only changed friends get a new entry
+                if old is not None: ## new friends have nothing to compare with
+                    events.extend(diff(old, friend))
+                self.snapshot[friend['nsaId']] = current
+        if len(self.snapshot) != len(seen):
+            for nsa_id in [nsa_id for nsa_id in self.snapshot if nsa_id not in seen]:
+                del self.snapshot[nsa_id]
+        if events:
+            self.dispatch(events, resolve)
+        return events
+
+    def dispatch(self, events, resolve):
+        for callback, keys in list(self.subscribers):
+            if keys is None:
+                selected = events
+            else:
+                wanted = {friend['nsaId'] for friend in map(resolve, keys) if friend is not None}
+                selected = [event for event in events if event.nsa_id in wanted]
+            for event in selected:
+                try:
+                    callback(event)
+                except Exception:
+                    logging.exception(f'Presence event subscriber failed on {event!r}.') ## one broken consumer shouldn't stop the others
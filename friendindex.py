@@ -0,0 +1,58 @@
+'''
+Index over a User's friend list, so that looking up the displayed user doesn't scan the whole list on every poll.
+'''
+
+class FriendIndex:
+    '''
+    Indexes friend records (as returned by User.get_friends_list) by nsaId, id and case-insensitive name.
+    Once a name has been found, it is remembered by nsaId, so the same friend is still found after changing their name.
+    '''
+
+    def __init__(self):
+        self.by_nsa_id = {}
+        self.by_id = {}
+        self.by_name = {}
+        self.names = {} ## nsaId -> (name, casefolded name) it is indexed under
+        self.aliases = {} ## key used in a lookup -> nsaId it resolved to
+
+    def update(self, friends):
+        '''
+        Replaces the indexed records with FRIENDS. Only keys of records that were added, removed or renamed are touched.
+        Records updated in place (see records.py) are recognized, so an unchanged friend costs no allocations.
+        '''
+        seen = set()
+        for friend in friends:
+            nsa_id = friend['nsaId']
+            seen.add(nsa_id)
+            name, folded = self.names.get(nsa_id, (None, None))
+            if name is not friend['name']: ## names are interned, so an unchanged name is the same object
+                if folded is not None and self.by_name.get(folded) is self.by_nsa_id.get(nsa_id):
+                    del self.by_name[folded]
+                name, folded = friend['name'], friend['name'].casefold()
+                self.names[nsa_id] = (name, folded)
+            if self.by_nsa_id.get(nsa_id) is not friend:
+                self.by_nsa_id[nsa_id] = friend
+                self.by_id[str(friend['id'])] = friend
+            self.by_name[folded] = friend
+        for nsa_id in [nsa_id for nsa_id in self.by_nsa_id if nsa_id not in seen]: ## no longer friends
+            old = self.by_nsa_id.pop(nsa_id)
+            self.by_id.pop(str(old['id']), None)
+            _, folded = self.names.pop(nsa_id)
+            if self.by_name.get(folded) is old:
+                del self.by_name[folded]
+
+    def find(self, key):
+        '''
+        Returns the record for KEY, which may be an nsaId, a name or an id, or None if there is no such friend.
+        '''
+        nsa_id = self.aliases.get(key)
+        if nsa_id in self.by_nsa_id: ## found before, follow the stable id even if the name changed since
+            return self.by_nsa_id[nsa_id]
+        key = str(key)
+        friend = self.by_nsa_id.get(key) or self.by_name.get(key.casefold()) or self.by_id.get(key)
+        if friend is not None:
+            self.aliases[key] = friend['nsaId']
+        return friend
+
+    def __len__(self):
+        return len(self.by_nsa_id)
@@ -0,0 +1,219 @@
+'''
+Generation of the f parameter (with its request_id and timestamp) that the login server requires. It can't be computed
+here, so it is requested from a provider: an imink-compatible f API over HTTP, or a local stand-in command. Several
+providers can be configured; each one's health and latency are tracked, the fastest healthy one is used and the others
+are tried in turn when it fails. The f parameter for a new id_token is prefetched as soon as the token is issued, so the
+login that needs it doesn't wait on the provider.
+'''
+
+import abc
+import json
+import logging
+import threading
+import time
+import backoff
+import errors
+import metrics
+
+DEFAULT_URLS = ('https://api.imink.app/f',) ## other providers receive the id_token too, so they are only used once configured
+PREFETCH_MAX_AGE = 300 ## seconds a prefetched f parameter is used for; the login server rejects old timestamps
+LATENCY_WEIGHT = 0.3 ## weight of the newest sample in a provider's average latency
+
+class Provider(abc.ABC):
+    '''
+    Source of f parameters. Subclasses implement generate().
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    @abc.abstractmethod
+    def generate(self, id_token, request, hash_method=1):
+        '''
+        Returns (f, request_id, timestamp) for ID_TOKEN. REQUEST is User.get_request, for providers that use HTTP.
+        Raises errors.ConnectionError or errors.InvalidAPIResponse on failure.
+        '''
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.name!r})'
+
+def parse_response(response):
+    '''
+    Returns (f, request_id, timestamp) from an imink-style RESPONSE dictionary.
+    '''
+    try:
+        return response['f'], response['request_id'], response['timestamp']
+    except (KeyError, TypeError):
+        logging.error('Invalid response received. See above response details.')
+        raise errors.InvalidAPIResponse() from None
+
+class HttpProvider(Provider):
+    '''
+    An imink-compatible f API at URL.
+    '''
+
+    def __init__(self, url, name=None):
+        super().__init__(name or url)
+        self.url = url
+
+    def generate(self, id_token, request, hash_method=1):
+        headers = {
+            'User-Agent': 'DiscordRPC4Switch/1.0',
+            'Content-Type': 'application/json; charset=utf-8'
+        }
+        return parse_response(request('post', self.url, headers=headers, json={'token': id_token, 'hash_method': hash_method}))
+
+class CommandProvider(Provider):
+    '''
+    A local stand-in: COMMAND reads an imink-style request ({"token": ..., "hash_method": ...}) as JSON on its standard
+    input and prints an imink-style JSON object, e.g. a script wrapping a self-hosted f API or an emulator. The id_token
+    isn't passed as an argument, where other local users could see it.
+    '''
+
+    def __init__(self, command, name=None, timeout=30):
+        import shlex
+        super().__init__(name or command)
+        self.command = shlex.split(command)
+        self.timeout = timeout
+
+    def generate(self, id_token, request, hash_method=1):
+        import subprocess
+        try:
+            completed = subprocess.run(
+                self.command, input=json.dumps({'token': id_token, 'hash_method': hash_method}),
+                capture_output=True, text=True, timeout=self.timeout, check=True
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.error(f'f parameter command {self.name} failed: {e}')
+            raise errors.ConnectionError() from None
+        try:
+            response = json.loads(completed.stdout)
+        except ValueError:
+            logging.error(f'f parameter command {self.name} printed something other than JSON.')
+            raise errors.InvalidAPIResponse() from None
+        return parse_response(response)
+
+class ProviderHealth:
+    '''
+    Failures and average latency of one provider.
+    '''
+
+    def __init__(self):
+        self.breaker = backoff.CircuitBreaker(failure_threshold=3, cooldown=120)
+        self.latency = None ## seconds, None until the first success
+
+    def record(self, seconds=None):
+        '''
+        Records a success that took SECONDS, or a failure if SECONDS is None.
+        '''
+        if seconds is None:
+            self.breaker.record_failure()
+            return
+        self.breaker.record_success()
+        self.latency = seconds if self.latency is None else (1 - LATENCY_WEIGHT) * self.latency + LATENCY_WEIGHT * seconds
+
+class ProviderPool:
+    '''
+    Generates f parameters with the fastest healthy provider of PROVIDERS, failing over to the others.
+    '''
+
+    def __init__(self, providers):
+        import concurrent.futures ## kept out of CLI startup, this module is imported to build the parser
+        if not providers:
+            raise ValueError('At least one f parameter provider is needed.')
+        self.providers = list(providers)
+        self.health = {provider.name: ProviderHealth() for provider in self.providers}
+        self.lock = threading.Lock()
+        self.prefetched = {} ## id_token -> (future, started_at)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='ftoken')
+
+    def ranked(self):
+        '''
+        Returns the providers in the order to try them: healthy ones first, untried then fastest, then the ones cooling
+        down after failures (still tried as a last resort).
+        '''
+        with self.lock:
+            def rank(provider):
+                health = self.health[provider.name]
+                return (health.breaker.seconds_until_retry() > 0, health.latency or 0)
+            return sorted(self.providers, key=rank)
+
+    def generate(self, id_token, request, hash_method=1):
+        '''
+        Returns (f, request_id, timestamp) for ID_TOKEN, from the prefetch if one was started for it.
+        '''
+        with self.lock:
+            future, started_at = self.prefetched.pop(id_token, (None, 0))
+        if future is not None and time.time() - started_at < PREFETCH_MAX_AGE:
+            try:
+                return future.result()
+            except (errors.ConnectionError, errors.InvalidAPIResponse):
+                pass ## every provider already failed once, but try again before giving up
+        return self.generate_now(id_token, request, hash_method)
+
+    def generate_now(self, id_token, request, hash_method=1):
+        error = None
+        for provider in self.ranked():
+            start = time.perf_counter()
+            try:
+                result = provider.generate(id_token, request, hash_method)
+            except (errors.ConnectionError, errors.InvalidAPIResponse) as e:
+                with self.lock:
+                    self.health[provider.name].record()
+                metrics.inc('f_provider_requests_total', provider=provider.name, result='failed')
+                logging.error(f'f parameter provider {provider.name} failed, trying the next one.')
+                error = e
+                continue
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.health[provider.name].record(seconds)
+            metrics.inc('f_provider_requests_total', provider=provider.name, result='ok')
+            metrics.observe('f_provider_seconds', seconds, provider=provider.name)
+            return result
+        raise error
+
+    def prefetch(self, id_token, request, hash_method=1):
+        '''
+        Starts generating the f parameter for ID_TOKEN in the background. Prefetches nobody used in time are dropped.
+        '''
+        with self.lock:
+            if id_token in self.prefetched:
+                return
+            now = time.time()
+            self.prefetched = {token: entry for token, entry in self.prefetched.items() if now - entry[1] < PREFETCH_MAX_AGE}
+            self.prefetched[id_token] = (self.executor.submit(self.generate_now, id_token, request, hash_method), now)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    '''
+    Returns the ProviderPool shared by the whole process, with the default providers unless configure() was called.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProviderPool([HttpProvider(url) for url in DEFAULT_URLS])
+        return _pool
+
+def configure(urls=(), commands=()):
+    '''
+    Replaces the shared pool with providers for URLS and local COMMANDS. Keeps the defaults if both are empty.
+    '''
+    global _pool
+    providers = [HttpProvider(url) for url in urls] + [CommandProvider(command) for command in commands]
+    with _pool_lock:
+        _pool = ProviderPool(providers) if providers else None
+
+def add_arguments(parser):
+    '''
+    Adds the f parameter provider options to an argparse PARSER.
+    '''
+    parser.add_argument('-f-api', action='append', default=[], metavar='URL', help=f'imink-compatible f API to generate f parameters with (it receives your id token). Can be repeated; the fastest healthy one is used. Default is {", ".join(DEFAULT_URLS)}.')
+    parser.add_argument('-f-command', action='append', default=[], metavar='COMMAND', help='Local command generating f parameters (reads an imink-style JSON request on stdin, prints imink-style JSON). Can be repeated.')
+
+def configure_from_args(args):
+    '''
+    Applies the options added by add_arguments.
+    '''
+    configure(args.f_api, args.f_command)
@@ -0,0 +1,89 @@
+'''
+Keeps track of when each displayed user started their current game, so that the elapsed time shown on Discord survives
+restarts and token refreshes instead of starting over from zero.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+MAX_GAP = 1800 ## seconds without seeing a friend after which their stored start is no longer trusted
+SEEN_SAVE_INTERVAL = 60 ## the last-seen time is only written to disk this often, not on every poll
+
+def session_start(presence, now=None):
+    '''
+    Returns when the game in PRESENCE was started: Nintendo's updatedAt, which changes when a game is launched, or NOW if
+    updatedAt is missing or implausible.
+    '''
+    now = time.time() if now is None else now
+    updated_at = presence.get('updatedAt') or 0
+    return int(updated_at) if 0 < updated_at <= now else int(now)
+
+class GameClock:
+    '''
+    Start times of the games being played, by nsaId, persisted to PATH.
+    '''
+
+    def __init__(self, path='cache/game_starts.json'):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as read:
+                self.starts = json.load(read) ## nsaId -> [game, start, last seen]
+        except (OSError, ValueError):
+            self.starts = {}
+
+    def start_of(self, nsa_id, presence):
+        '''
+        Returns the start time of the game in PRESENCE for the friend NSA_ID, or None if they aren't playing anything.
+        The start time is kept for as long as they keep playing the same game, across restarts. A new session starts when
+        Nintendo reports a presence change after the stored start, or when the friend wasn't seen for MAX_GAP seconds
+        (e.g. the process was stopped for a while and they played the same game again since).
+        '''
+        now = time.time()
+        game = (presence.get('game') or {}).get('name') if presence['state'] == 'ONLINE' else None
+        with self.lock:
+            known = self.starts.get(nsa_id)
+            if game is None:
+                if known is not None:
+                    del self.starts[nsa_id]
+                    self.save()
+                return None
+            if known is not None and len(known) == 3 and known[0] == game and now - known[2] <= MAX_GAP and max(presence.get('updatedAt') or 0, presence.get('logoutAt') or 0) <= known[1]:
+                if now - known[2] > SEEN_SAVE_INTERVAL:
+                    known[2] = now
+                    self.save()
+                return known[1]
+            self.starts[nsa_id] = [game, session_start(presence, now), now]
+            self.save()
+            return self.starts[nsa_id][1]
+
+    def save(self):
+        '''
+        Writes the start times to disk. Called with the lock held, and only when something changed.
+        '''
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as outfile:
+                json.dump(self.starts, outfile)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.error(f'Failed to save game start times: {e}')
+
+_clock = None
+_clock_lock = threading.Lock()
+
+def get_clock():
+    '''
+    Returns the GameClock shared by the whole process, creating it on first use.
+    '''
+    global _clock
+    with _clock_lock:
+        if _clock is None:
+            _clock = GameClock()
+        return _clock
@@ -0,0 +1,163 @@
+'''
+Play session history: every game session seen for a tracked user is appended to a SQLite database, and play time can be
+aggregated per game, per day or per friend. Writes are queued and committed in batches by a background thread, so the
+poll loop never waits on the disk.
+'''
+
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import gameclock
+
+BATCH_INTERVAL = 60 ## seconds between commits of queued sessions
+
+class HistoryStore:
+    '''
+    Append-only log of game sessions in PATH.
+    '''
+
+    def __init__(self, path='users/history.db'):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.queue = queue.Queue()
+        self.writer = None
+        connection = self.connect()
+        with connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id INTEGER PRIMARY KEY,
+                    main_user TEXT NOT NULL,
+                    nsa_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    game TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    ended_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS sessions_by_game ON sessions (game, started_at);
+                CREATE INDEX IF NOT EXISTS sessions_by_friend ON sessions (nsa_id, started_at);
+                CREATE INDEX IF NOT EXISTS sessions_by_start ON sessions (started_at);
+            ''')
+        connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def append(self, main_user, nsa_id, name, game, started_at, ended_at):
+        '''
+        Queues a finished session. It is written by the background writer within BATCH_INTERVAL seconds.
+        '''
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_batches, daemon=True)
+            self.writer.start()
+            atexit.register(self.flush)
+        self.queue.put((main_user, nsa_id, name, game, started_at, ended_at))
+
+    def write_batches(self):
+        connection = self.connect()
+        while True:
+            time.sleep(BATCH_INTERVAL)
+            self.flush(connection)
+
+    def flush(self, connection=None):
+        '''
+        Writes every queued session in one transaction.
+        '''
+        rows = []
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return
+        own_connection = connection is None
+        connection = self.connect() if own_connection else connection
+        try:
+            with connection:
+                connection.executemany('INSERT INTO sessions (main_user, nsa_id, name, game, started_at, ended_at) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error as e:
+            logging.error(f'Failed to write {len(rows)} sessions to the history: {e}')
+        finally:
+            if own_connection:
+                connection.close()
+
+    def totals(self, by='game', friend=None, since=None):
+        '''
+        Returns (group, seconds played, sessions) rows, most played first. BY is 'game', 'day' or 'friend'. FRIEND limits
+        the rows to one friend (name or nsaId) and SINCE to sessions started after that timestamp. Friends are grouped by
+        nsaId and shown with their latest name, so renames don't split them and namesakes aren't merged.
+        '''
+        group, label = {
+            'game': ('game', 'game'),
+            'day': ("date(started_at, 'unixepoch', 'localtime')", "date(started_at, 'unixepoch', 'localtime')"),
+            'friend': ('nsa_id', 'name') ## with MAX(started_at), SQLite takes the bare name from the latest session
+        }[by]
+        conditions, parameters = [], []
+        if friend is not None:
+            conditions.append('(nsa_id = ? OR name = ?)')
+            parameters += [friend, friend]
+        if since is not None:
+            conditions.append('started_at >= ?')
+            parameters.append(since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'ORDER BY 1 DESC' if by == 'day' else 'ORDER BY 2 DESC'
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                f'SELECT {label}, SUM(ended_at - started_at), COUNT(*), MAX(started_at) FROM sessions {where} GROUP BY {group} {order}', parameters
+            ).fetchall()
+            return [row[:3] for row in rows]
+        finally:
+            connection.close()
+
+class SessionRecorder:
+    '''
+    Turns the statuses seen by a poll loop into sessions in a HistoryStore: a session starts when a friend is seen playing
+    a game and ends when they switch games, stop playing or the process exits.
+    '''
+
+    def __init__(self, store, main_user_name):
+        self.store = store
+        self.main_user_name = main_user_name
+        self.open_sessions = {} ## nsaId -> (name, game, started_at)
+        self.seen = set() ## nsaIds observed by this process; a game already running when first seen was recorded up to the last exit
+        atexit.register(self.close)
+
+    def observe(self, status, now=None):
+        '''
+        Records STATUS, a friend dictionary from the latest poll.
+        '''
+        now = time.time() if now is None else now
+        presence = status['presence']
+        game = (presence.get('game') or {}).get('name') if presence['state'] == 'ONLINE' else None
+        current = self.open_sessions.get(status['nsaId'])
+        if current is not None and current[1] == game:
+            return
+        if game is not None:
+            started_at = gameclock.session_start(presence, now) if status['nsaId'] in self.seen else now
+        if current is not None: ## a switch ends the previous game when the new one started, so no time is counted twice
+            self.end(status['nsaId'], now if game is None else max(current[2], started_at))
+        if game is not None:
+            self.open_sessions[status['nsaId']] = (status['name'], game, started_at)
+        self.seen.add(status['nsaId'])
+
+    def end(self, nsa_id, now):
+        name, game, started_at = self.open_sessions.pop(nsa_id)
+        self.store.append(self.main_user_name, nsa_id, name, game, started_at, now)
+
+    def close(self):
+        '''
+        Ends every open session now.
+        '''
+        now = time.time()
+        for nsa_id in list(self.open_sessions):
+            self.end(nsa_id, now)
+        self.store.flush()
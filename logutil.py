@@ -0,0 +1,37 @@
+'''
+Helpers for logging request and response bodies cheaply and without leaking credentials.
+'''
+
+import json
+
+MAX_LOGGED_BODY = 2000 ## characters of a body written to the log, the rest is cut off
+SECRET_KEYS = {
+    'authorization', 'session_token', 'session_token_code', 'session_token_code_verifier', 'access_token', 'id_token',
+    'accesstoken', 'naidtoken', 'token', 'f', 'requestid', 'request_id'
+}
+
+def redact(value):
+    '''
+    Returns a copy of VALUE (decoded JSON) with the values of secret keys replaced.
+    '''
+    if isinstance(value, dict):
+        return {key: '<redacted>' if str(key).lower() in SECRET_KEYS else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+class Lazy:
+    '''
+    Wraps a body so that it is only redacted and formatted if the log record is actually written. Pass it as a logging
+    argument (logging.info('%s', Lazy(body))) rather than formatting it into the message.
+    '''
+
+    def __init__(self, value, limit=MAX_LOGGED_BODY):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = json.dumps(redact(self.value), default=str)
+        if len(text) > self.limit:
+            text = f'{text[:self.limit]}... ({len(text)} characters)'
+        return text
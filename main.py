@@ -1,40 +1,37 @@
+'''
+Command line entry point. Only the modules a subcommand needs are imported, when it runs, so that quick subcommands like
+accounts or --help don't pay for requests, pypresence or asyncio.
+'''
+
 import argparse
-import pickle
-import user
-import discordrpc
-import time
 import os
-import re
-import logging
-import logging.config
-import errors
-import sessiontoken
 import sys
+import time
 
-def get_user(user_name):
+store = None
+
+def get_store():
     '''
-    Finds the User with name USER_NAME from the users directory and returns the corresponding ACCOUNT.
+    Returns the account store in the users directory, opening it on first use.
     '''
-    try:
-        with open(f'users/{user_name}.pickle', 'rb') as read:
-            account = pickle.load(read)
-        assert account.version == user.User.version
-    except FileNotFoundError: ## invalid user
-        raise errors.InvalidRegisteredUser()
-    except AssertionError:
-        raise errors.OutdatedUser()
+    global store
+    if store is None:
+        import accountstore
+        store = accountstore.AccountStore('users')
+    return store
 
-    return account
+def get_user(user_name):
+    '''
+    Finds the User with name USER_NAME in the account store and returns the corresponding ACCOUNT.
+    '''
+    import user
+    return get_store().load(user_name, user.User.version)
 
 def accounts(args: argparse.Namespace): 
     '''
-    Prints a series of account names from the accounts in the users directory.
+    Prints a series of account names from the accounts in the account store.
     '''
-    accounts = []
-    account_files = [re.findall('(.*)\.pickle$', file)[0] for file in os.listdir('users/') if os.path.isfile(os.path.join("users/", file)) and re.search(".*\.pickle$", file)]
-    for account_file in account_files:
-        temp_user = get_user(account_file)
-        accounts.append(temp_user.get_name())
+    accounts = get_store().names() ## read from the index, no User has to be loaded
     if len(accounts) == 0:
         print('You have no accounts. Please register one.')
     else:
@@ -46,6 +43,7 @@ def friends(args: argparse.Namespace):
     Prints a series of friends of the specified user in ARGS.
     '''
     user = get_user(args.user)
+    user.on_login = get_store().save ## renewed tokens are kept for the next run
     friends = user.get_friends_list()
     if len(friends) == 0:
         print('You have no friends.')
@@ -53,57 +51,137 @@ def friends(args: argparse.Namespace):
         friends_str = f"List of friends: {', '.join(str(friend['name']) for friend in friends)}"
         print(friends_str)
 
+def status(args: argparse.Namespace):
+    '''
+    Logs in every registered account (or the ones named in ARGS) concurrently, fetches their friend lists in parallel and
+    prints each account's friends (and the account itself) as soon as that account is done, as NDJSON or as a table.
+    Accounts that fail are reported in the output too, and make the exit status 1.
+    '''
+    import concurrent.futures
+    import json
+    import errors
+    import ftoken
+    import user
+
+    ftoken.configure_from_args(args)
+    names = args.accounts or get_store().names()
+    if len(names) == 0:
+        print('You have no accounts. Please register one.')
+        return
+
+    def emit(account_name, record=None, error=None):
+        if args.format == 'ndjson':
+            line = {'account': account_name, 'error': error} if error is not None else {'account': account_name, **record.to_dict()}
+            print(json.dumps(line, ensure_ascii=False))
+        elif error is not None:
+            print(f'{account_name:20} error: {error}')
+        else:
+            game = (record['presence'].get('game') or {}).get('name') or ''
+            print(f"{account_name:20} {record['name']:20} {record['presence']['state']:8} {game}")
+
+    def fetch(account):
+        account.login()
+        return account.get_all_status()
+
+    if args.format == 'table':
+        print(f"{'ACCOUNT':20} {'NAME':20} {'STATE':8} GAME")
+    failed = False
+    accounts = {}
+    for name in names: ## loaded up front, the store is read from this thread only
+        try:
+            accounts[name] = get_user(name)
+            accounts[name].on_login = get_store().save ## renewed tokens are kept for the next run
+        except (errors.InvalidRegisteredUser, errors.OutdatedUser) as e:
+            emit(name, error=str(e))
+            failed = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='status') as executor:
+        futures = {executor.submit(fetch, account): name for name, account in accounts.items()}
+        for future in concurrent.futures.as_completed(futures): ## fastest accounts first, nobody waits for the slowest
+            try:
+                records = future.result()
+            except Exception as e:
+                emit(futures[future], error=str(e) or type(e).__name__)
+                failed = True
+            else:
+                for record in records:
+                    emit(futures[future], record)
+            sys.stdout.flush()
+    if failed:
+        sys.exit(1)
+
 def register(args: argparse.Namespace):
     '''
     Registers a user by generating a URL with help from a S256 code challenge directing the User to copy a link to paste here
-    and create a new User object which is then serialized in the users directory (created if doesn't exist).
+    and create a new User object which is then saved in the account store in the users directory (created if doesn't exist).
+    The tokens obtained while registering are saved with it, so the first discord session can reuse them.
     '''
+    import sessiontoken
+    import user
     session_token = sessiontoken.get_token()
     register_user = user.User(session_token)
     register_user.login()
     
-    if os.path.exists(f'users/{register_user.get_name()}.pickle'): ## already exists
+    if get_store().exists(register_user.get_name()): ## already exists
         print('Note: If you are trying to register a *different* account with the same name as a registered account, nxsence does not support that at the moment.')
         override = input('A user with this name already has been registered: Override? (y/n): ')
         if override.lower() != 'y':
             print('Quitting...')
             exit()
 
-    if not os.path.exists('users'):
-        os.mkdir('users')
-    
-    with open(f'users/{register_user.get_name()}.pickle', 'wb') as outfile: ## serialize user
-        pickle.dump(register_user, outfile)
+    get_store().save(register_user)
+
+def setup_logging():
+    '''
+    Sends log output to a new file in the logs directory (created if doesn't exist).
+    '''
+    import logging
+    date = int(time.time())
+    if not os.path.exists('logs'):
+        os.mkdir('logs')
+    logging.basicConfig(
+        filename=f'logs/log_{date}.txt',
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S',
+        force=True
+    )
 
 def discord(args: argparse.Namespace):
     '''
-    Links with an active Discord instance and sends updates on the User's status every thirty seconds.
+    Links with an active Discord instance and sends updates on the User's status, polling more often right after it changes
+    and less often while the displayed user is offline.
     '''
+    import logging
+    import appversion
+    import asyncloop
+    import backoff
+    import discordrpc
+    import errors
+    import ftoken
+    import history
+    import metrics
+    import profiling
+    import refresher
+    import scheduler
+    import user
     main_user_name = args.main_user
     displayed_user_name = args.displayed_user
+    appversion.cache.ttl = args.version_ttl
+    ftoken.configure_from_args(args)
     main_user: user.User = get_user(main_user_name)
+    metrics.start_from_args(args)
+    main_user.on_login = get_store().save ## refreshed tokens are saved, so a restart only renews what has expired
+
+    ## set up logger
+    if args.log:
+        setup_logging()
+    main_user.toggle_log(args.log) ## a saved User may have been saved with logging on
+
     main_user.login()
     
     ## check for who the displayed_user is: if it's None, display main_user status, otherwise display friend status
     if displayed_user_name is None:
         displayed_user_name = main_user_name
-
-    ## used for knowing when to refresh webApiCredential
-    start_time = time.time()
-
-    ## set up logger
-    if args.log:
-        date = int(time.time())
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        logging.basicConfig(
-            filename=f'logs/log_{date}.txt',
-            format='%(asctime)s %(levelname)-8s %(message)s',
-            level=logging.INFO,
-            datefmt='%Y-%m-%d %H:%M:%S',
-            force=True
-        )
-        main_user.toggle_log()
     
     discord = discordrpc.Discord(args.log) ## separate from User toggle_log because of how User is set up (serialization)
 
@@ -111,92 +189,171 @@ def discord(args: argparse.Namespace):
 
     print(f'Displaying status for {displayed_user_name}. To exist, press CTRL+C.')
 
-    active_game: dict = {} ## used to figure out current game's playtime, key: game name, value: time started (need to know how long User has been playing)
+    recorder = None if args.no_history else history.SessionRecorder(history.HistoryStore(), main_user_name) ## play time for the history subcommand
+
+    if args.use_async: ## token refresh, friend polling and Discord updates run as independent tasks
+        asyncloop.run(main_user, displayed_user_name, discord, scheduler.from_args(args), recorder=recorder)
+        return
+
+    refresher.TokenRefresher(main_user).start() ## renews the tokens ahead of expiry, so polls never wait on a login
+    poll_scheduler = scheduler.from_args(args)
+    profiler = profiling.from_args(args)
+    failures = backoff.Backoff(base=5, cap=600) ## for Nintendo/imink failures, which are retried instead of ending the process
+    next_poll = time.monotonic()
 
     ## update Discord status
     while True:
+        if not discord.connected: ## don't poll Nintendo while there is nowhere to show the result
+            print('Lost connection to Discord, waiting for it to come back...')
+            discord.connect()
+            next_poll = time.monotonic()
+        tick_start = time.monotonic()
+        metrics.observe('poll_lag_seconds', max(0, tick_start - next_poll))
 
-        current_time = time.time()
-        if current_time - start_time > 5400: ## refresh login every hour and thirty minutes
-            logging.info("Attempting to refresh login...")
-            main_user.login()
-            start_time = current_time
-
-        ## iterate and find user?
-        displayed_user_status = main_user.get_account_status(displayed_user_name)
-        try: ## ensure that this display user really exists (either is self or comes from friends list)
-            assert isinstance(displayed_user_status, dict)
-        except AssertionError:
-            logging.error(f"Failed to find the user {displayed_user_name}.")
-            raise errors.InvalidDisplayUser()
-        
-        logging.info("Fetching user status...")
-
-        user_state = displayed_user_status['presence']['state']
-        mii = displayed_user_status['imageUri']
-
-        if user_state == 'ONLINE':
-            try: ## figure out current playtime, assuming active_game has been updated to include this currently-playing game
-                game = displayed_user_status['presence']['game']['name']
-                start = active_game[game]
-            except KeyError:
-                game = displayed_user_status['presence']['game']['name']
-                active_game = {} ## clear dictionary for new game
-                active_game[game] = int(time.time())
-                start = active_game[game]
-                gameAsset = displayed_user_status['presence']['game']['imageUri']
-
-                ## update the client
-                discord.update(
-                    large_image=gameAsset,
-                    large_text=game,
-                    small_image=mii,
-                    small_text=displayed_user_status['name'],
-                    status=f"Playing {game}",
-                    start=start
-                )
-        elif user_state == 'INACTIVE':
-            active_game = {}
-            discord.update(
-                large_image='switch',
-                large_text='Home Screen',
-                small_image=displayed_user_status['imageUri'],
-                small_text=displayed_user_status['name'],
-                status="Online"
-            )
-        else:
-            pass
-        time.sleep(30) ## update Discord status every thirty seconds
+        try:
+            with profiler.tick(): ## only does something while profiling (-profile-ticks, -trace-memory, SIGUSR1/SIGUSR2)
+                main_user.refresh_login() ## fallback if the background refresh kept failing, otherwise does nothing
+
+                ## iterate and find user?
+                displayed_user_status = main_user.get_account_status(displayed_user_name)
+                try: ## ensure that this display user really exists (either is self or comes from friends list)
+                    assert displayed_user_status is not None
+                except AssertionError:
+                    logging.error(f"Failed to find the user {displayed_user_name}.")
+                    raise errors.InvalidDisplayUser()
+                
+                logging.info("Fetching user status...")
+
+                discord.display(displayed_user_status)
+                if recorder is not None:
+                    recorder.observe(displayed_user_status)
+        except errors.DiscordError:
+            continue ## reconnects at the top of the loop, the last status is resent once connected
+        except (errors.ConnectionError, errors.InvalidAPIResponse, errors.InvalidAppVersion) as e:
+            delay = failures.next_delay()
+            logging.error(f'{e} Retrying in {delay:.0f} seconds.')
+            next_poll = time.monotonic() + delay
+            time.sleep(delay)
+            continue
+        failures.reset()
+        metrics.observe('poll_seconds', time.monotonic() - tick_start)
+        delay = poll_scheduler.next_delay(displayed_user_status)
+        next_poll = time.monotonic() + delay
+        time.sleep(delay)
+
+def daemon(args: argparse.Namespace):
+    '''
+    Shares the status of several users to Discord at once, as described by the config file in ARGS.
+    Each main user is logged in once and its friend list is fetched once per tick for all of its targets.
+    '''
+    import appversion
+    import daemonloop
+    import ftoken
+    import history
+    import metrics
+    import profiling
+    import scheduler
+    appversion.cache.ttl = args.version_ttl
+    ftoken.configure_from_args(args)
+    if args.log:
+        setup_logging()
+    metrics.start_from_args(args)
+    targets = daemonloop.load_config(args.config)
+    daemonloop.run(targets, get_user, args.log, lambda: scheduler.from_args(args), get_store().save, None if args.no_history else history.HistoryStore(), profiling.from_args(args))
+
+def history_command(args: argparse.Namespace):
+    '''
+    Prints the recorded play time, grouped by game, day or friend.
+    '''
+    import history
+    since = None if args.days is None else time.time() - args.days * 86400
+    rows = history.HistoryStore().totals(args.by, args.friend, since)
+    if len(rows) == 0:
+        print('No play sessions recorded yet.')
+        return
+    for group, seconds, sessions in rows:
+        hours, minutes = divmod(int(seconds) // 60, 60)
+        print(f'{group}: {hours}h {minutes:02d}m ({sessions} sessions)')
+
+def build_parser():
+    '''
+    Returns the parser for every subcommand. Only the lightweight modules that add shared arguments are imported here.
+    '''
+    import ftoken
+    import metrics
+    import profiling
+    import scheduler
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(title='subcommands', description='Valid subcommands')
 
-## parsing to identify subcommands
-parser = argparse.ArgumentParser()
-subparsers = parser.add_subparsers(title='subcommands', description='Valid subcommands')
+    ## register
+    parser_register = subparsers.add_parser('register', description='Register a new account to use.')
+    parser_register.set_defaults(func=register)
 
-## register
-parser_register = subparsers.add_parser('register', description='Register a new account to use.')
-parser_register.set_defaults(func=register)
+    ## discord
+    parser_discord = subparsers.add_parser('discord', description='Begin sharing Nintendo Switch game status to Discord')
+    parser_discord.add_argument('main_user', help='The user to login to.')
+    parser_discord.add_argument('displayed_user', nargs='?', default=None, help='The user whose status to share to Discord. Default the logged-in user')
+    parser_discord.add_argument('-log', action='store_true', help='Produces a log that can be useful in debugging issues. Default is False.')
+    parser_discord.add_argument('-no-history', action='store_true', help='Do not record play sessions for the history subcommand. Default is False.')
+    parser_discord.add_argument('-async', '--async', dest='use_async', action='store_true', help='Run token refresh, friend polling and Discord updates concurrently with asyncio. Cannot be combined with -profile-ticks or -trace-memory. Default is False.')
+    parser_discord.add_argument('-version-ttl', type=int, default=86400, help='Seconds to reuse the cached NSO app version before looking it up again. Default is 86400.')
+    scheduler.add_arguments(parser_discord)
+    ftoken.add_arguments(parser_discord)
+    profiling.add_arguments(parser_discord)
+    metrics.add_arguments(parser_discord)
+    parser_discord.set_defaults(func=discord)
 
-## discord
-parser_discord = subparsers.add_parser('discord', description='Begin sharing Nintendo Switch game status to Discord')
-parser_discord.add_argument('main_user', help='The user to login to.')
-parser_discord.add_argument('displayed_user', nargs='?', default=None, help='The user whose status to share to Discord. Default the logged-in user')
-parser_discord.add_argument('-log', action='store_true', help='Produces a log that can be useful in debugging issues. Default is False.')
-parser_discord.set_defaults(func=discord)
+    ## daemon
+    parser_daemon = subparsers.add_parser('daemon', description='Share the status of several users to Discord, as listed in a config file.')
+    parser_daemon.add_argument('config', help='JSON file listing the targets, e.g. {"targets": [{"main_user": "A", "displayed_user": "B", "client_id": "...", "pipe": 0}]}.')
+    parser_daemon.add_argument('-log', action='store_true', help='Produces a log that can be useful in debugging issues. Default is False.')
+    parser_daemon.add_argument('-no-history', action='store_true', help='Do not record play sessions for the history subcommand. Default is False.')
+    parser_daemon.add_argument('-version-ttl', type=int, default=86400, help='Seconds to reuse the cached NSO app version before looking it up again. Default is 86400.')
+    scheduler.add_arguments(parser_daemon)
+    ftoken.add_arguments(parser_daemon)
+    profiling.add_arguments(parser_daemon)
+    metrics.add_arguments(parser_daemon)
+    parser_daemon.set_defaults(func=daemon)
 
-## accounts
-parser_accounts = subparsers.add_parser('accounts', description='Get a list of registered accounts.')
-parser_accounts.set_defaults(func=accounts)
+    ## accounts
+    parser_accounts = subparsers.add_parser('accounts', description='Get a list of registered accounts.')
+    parser_accounts.set_defaults(func=accounts)
 
-## friends
-parser_friends = subparsers.add_parser('friends', description="Get a list of this user's friends.")
-parser_friends.add_argument('user', help='The user whose friends you wish to see.')
-parser_friends.set_defaults(func=friends)
+    ## history
+    parser_history = subparsers.add_parser('history', description='Show recorded play time.')
+    parser_history.add_argument('-by', choices=['game', 'day', 'friend'], default='game', help='How to group play time. Default is game.')
+    parser_history.add_argument('-friend', default=None, help='Only show play time of this friend (name or nsaId).')
+    parser_history.add_argument('-days', type=float, default=None, help='Only include sessions started in the last this many days.')
+    parser_history.set_defaults(func=history_command)
 
-args = parser.parse_args()
+    ## status
+    parser_status = subparsers.add_parser('status', description='Get the presence of the friends of every registered account at once.')
+    parser_status.add_argument('accounts', nargs='*', help='The accounts to include. Default is every registered account.')
+    parser_status.add_argument('-format', choices=['ndjson', 'table'], default='ndjson', help='One JSON object per line, or a table. Default is ndjson.')
+    parser_status.add_argument('-workers', type=int, default=8, help='Accounts to log in and fetch at the same time. Default is 8.')
+    ftoken.add_arguments(parser_status)
+    parser_status.set_defaults(func=status)
 
+    ## friends
+    parser_friends = subparsers.add_parser('friends', description="Get a list of this user's friends.")
+    parser_friends.add_argument('user', help='The user whose friends you wish to see.')
+    parser_friends.set_defaults(func=friends)
 
-try:
-    func = args.func
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'use_async', False) and (args.profile_ticks or args.trace_memory): ## the asyncio loop has no poll ticks to profile
+        parser.error('-profile-ticks and -trace-memory cannot be used with -async.')
+    try:
+        func = args.func
+    except AttributeError:
+        print("usage: DiscordRPC4Switch [-h] {register,discord,daemon,accounts,history,status,friends} ...\n\noptions:\n  -h, --help            show this help message and exit\n\nsubcommands:\n  Valid subcommands\n\n  {register,discord,daemon,accounts,history,status,friends})")
+        return
     func(args)
-except AttributeError as e:
-    print("usage: DiscordRPC4Switch [-h] {register,discord,accounts,friends} ...\n\noptions:\n  -h, --help            show this help message and exit\n\nsubcommands:\n  Valid subcommands\n\n  {register,discord,accounts,friends})")
\ No newline at end of file
+
+if __name__ == '__main__':
+    main()
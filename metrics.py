@@ -0,0 +1,178 @@
+'''
+In-process metrics for the polling daemon: request counts and latencies per endpoint, credential refreshes, failures by
+error type, poll loop lag and Discord updates. They can be served in the Prometheus text format over HTTP or written to a
+file periodically.
+'''
+
+import functools
+import logging
+import os
+import threading
+import time
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) ## seconds
+
+_lock = threading.Lock()
+_counters = {} ## (name, labels) -> value
+_histograms = {} ## (name, labels) -> [bucket counts..., sum, count]
+_help = {
+    'requests_total': 'HTTP requests made, by endpoint and status.',
+    'request_seconds': 'HTTP request latency, by endpoint.',
+    'refreshes_total': 'Credential refresh steps performed, by step.',
+    'background_refreshes_total': 'Logins renewed by the background refresher, by result.',
+    'f_provider_requests_total': 'f parameter generations, by provider and result.',
+    'f_provider_seconds': 'f parameter generation latency, by provider.',
+    'login_step_seconds': 'Time taken by each step of a full login, by step.',
+    'failures_total': 'Failures, by error type and operation.',
+    'poll_lag_seconds': 'How much later than scheduled each poll started.',
+    'poll_seconds': 'Time taken by each poll tick.',
+    'discord_updates_total': 'Discord presence updates, by result.'
+}
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items())) ## e.g. status=200 and status='connection_error' sort together
+
+def inc(name, amount=1, **labels):
+    '''
+    Adds AMOUNT to the counter NAME with LABELS.
+    '''
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, value, **labels):
+    '''
+    Records VALUE (in seconds) in the histogram NAME with LABELS.
+    '''
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+_operations = threading.local() ## whether this thread is already inside a count_failures operation
+
+def count_failures(operation):
+    '''
+    Decorator counting exceptions raised by the decorated function in failures_total, labelled with OPERATION.
+    Decorated functions call each other (get_friends_list may log in again), so a failure is only counted by the
+    outermost operation running on the thread, not once per level it passes through.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            outermost = not getattr(_operations, 'active', False)
+            _operations.active = True
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if outermost:
+                    inc('failures_total', type=type(e).__name__, operation=operation)
+                raise
+            finally:
+                if outermost:
+                    _operations.active = False
+        return wrapper
+    return decorator
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value)}"' for name, value in labels) + '}'
+
+def render():
+    '''
+    Returns every metric in the Prometheus text exposition format.
+    '''
+    lines = []
+    with _lock:
+        counters, histograms = dict(_counters), {key: list(value) for key, value in _histograms.items()}
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# HELP nxrpc_{name} {_help.get(name, name)}')
+        lines.append(f'# TYPE nxrpc_{name} counter')
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f'nxrpc_{name}{_format_labels(labels)} {value}')
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# HELP nxrpc_{name} {_help.get(name, name)}')
+        lines.append(f'# TYPE nxrpc_{name} histogram')
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(BUCKETS, histogram):
+                lines.append(f'nxrpc_{name}_bucket{_format_labels(labels, [("le", bound)])} {count}')
+            lines.append(f'nxrpc_{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {histogram[-1]}')
+            lines.append(f'nxrpc_{name}_sum{_format_labels(labels)} {histogram[-2]:.6f}')
+            lines.append(f'nxrpc_{name}_count{_format_labels(labels)} {histogram[-1]}')
+    return '\n'.join(lines) + '\n'
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def serve(port, host='127.0.0.1'):
+    '''
+    Serves the metrics at http://HOST:PORT/metrics from a background thread.
+    '''
+    import http.server ## only needed with -metrics-port, kept out of CLI startup
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def dump_periodically(path, interval):
+    '''
+    Writes the metrics to PATH every INTERVAL seconds from a background thread (e.g. for a node_exporter textfile collector).
+    '''
+    def dump():
+        while True:
+            time.sleep(interval)
+            temp_path = f'{path}.tmp'
+            try:
+                with open(temp_path, 'w') as outfile:
+                    outfile.write(render())
+                os.replace(temp_path, path)
+            except OSError as e: ## e.g. a full disk, the next dump tries again
+                logging.error(f'Failed to write the metrics to {path}: {e}')
+
+    threading.Thread(target=dump, daemon=True).start()
+
+def add_arguments(parser):
+    '''
+    Adds the options enabling metrics export to the argparse PARSER.
+    '''
+    parser.add_argument('-metrics-port', type=int, default=None, help='Serve Prometheus metrics at http://127.0.0.1:PORT/metrics. Default is off.')
+    parser.add_argument('-stats-interval', type=float, default=None, help='Write metrics to logs/metrics.prom every this many seconds. Default is off.')
+
+def start_from_args(args):
+    '''
+    Starts whichever exports were enabled with the options from add_arguments.
+    '''
+    if args.metrics_port is not None:
+        serve(args.metrics_port)
+    if args.stats_interval is not None:
+        if not os.path.exists('logs'):
+            os.mkdir('logs')
+        dump_periodically(os.path.join('logs', 'metrics.prom'), args.stats_interval)
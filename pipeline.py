@@ -0,0 +1,51 @@
+'''
+Runs steps that depend on each other concurrently: each step starts as soon as the steps it requires have finished, so
+the whole run takes as long as its longest chain of steps rather than the sum of all of them.
+'''
+
+import concurrent.futures
+import time
+
+def run(steps, max_workers=4):
+    '''
+    Runs STEPS, a list of (name, function, requires) where REQUIRES names the steps that must finish first, and returns
+    how many seconds each step took, by name. If a step raises, the steps that haven't started yet are skipped and the
+    exception is raised once the running ones have finished.
+    '''
+    names = {name for name, _, _ in steps}
+    for name, _, requires in steps:
+        unknown = set(requires) - names
+        if unknown:
+            raise ValueError(f'Step {name} requires unknown steps {sorted(unknown)}.')
+    timings = {}
+    done = set()
+    pending = list(steps)
+    running = {} ## future -> name
+    error = None
+
+    def timed(function):
+        start = time.perf_counter()
+        function()
+        return time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pipeline') as executor:
+        while pending or running:
+            if error is None:
+                for step in [step for step in pending if set(step[2]) <= done]:
+                    pending.remove(step)
+                    running[executor.submit(timed, step[1])] = step[0]
+            if not running: ## nothing left that can start
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    timings[name] = future.result()
+                    done.add(name)
+                except Exception as e:
+                    error = error or e
+    if error is not None:
+        raise error
+    if pending:
+        raise ValueError(f'Steps {[step[0] for step in pending]} require each other.')
+    return timings
@@ -0,0 +1,175 @@
+'''
+On-demand profiling of a running poll loop, without restarting it under a debugger. cProfile can be run around the next N
+poll ticks, and tracemalloc snapshots can be compared between ticks to find what keeps growing. Both can be started from
+the command line or, on platforms that have them, by sending SIGUSR1 (profile) or SIGUSR2 (memory snapshot) to the
+process. Reports are written to the logs directory.
+'''
+
+import contextlib
+import logging
+import os
+import signal
+import time
+
+DEFAULT_TICKS = 20 ## ticks profiled per SIGUSR1
+TRACEBACK_FRAMES = 10 ## frames kept per allocation, so allocations can be traced back to their caller
+TOP_LINES = 25 ## lines per section of a memory report
+HOT_PATHS = r'get_request|json|discordrpc|records' ## requests, JSON parsing and Discord updates, listed separately in profiles
+
+class Profiler:
+    '''
+    Profiles the poll ticks run inside tick(). Profiles cover TICKS ticks; with MEMORY_INTERVAL, a memory snapshot is
+    compared with the previous one every MEMORY_INTERVAL ticks. Reports go to DIRECTORY.
+    '''
+
+    def __init__(self, directory='logs', ticks=DEFAULT_TICKS, memory_interval=0):
+        self.directory = directory
+        self.ticks = ticks
+        self.memory_interval = memory_interval
+        self.profile = None
+        self.profile_left = 0 ## ticks still to profile
+        self.profiled_ticks = 0
+        self.ticks_seen = 0
+        self.snapshot_requested = False
+        self.last_snapshot = None
+        if memory_interval:
+            import tracemalloc
+            tracemalloc.start(TRACEBACK_FRAMES)
+
+    def start_profile(self, ticks=None):
+        '''
+        Profiles the next TICKS ticks (default: the TICKS given to the constructor).
+        '''
+        self.profile_left = ticks or self.ticks
+
+    def request_snapshot(self):
+        '''
+        Takes a memory snapshot after the current tick. The first request only starts tracing allocations; every later
+        one writes a report comparing with the previous snapshot.
+        '''
+        self.snapshot_requested = True
+
+    def install_signals(self):
+        '''
+        Starts a profile on SIGUSR1 (or ends a running one after the current tick) and takes a memory snapshot on SIGUSR2.
+        Does nothing where these signals don't exist (Windows).
+        '''
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        def on_profile_signal(signum, frame):
+            self.profile_left = 1 if self.profile_left > 0 else self.ticks ## only flags are set, the work happens between ticks
+        signal.signal(signal.SIGUSR1, on_profile_signal)
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.request_snapshot())
+
+    @contextlib.contextmanager
+    def tick(self):
+        '''
+        Wraps one poll tick. Sleeping between ticks stays outside, so reports only show the work done.
+        '''
+        profiling = self.profile_left > 0
+        if profiling:
+            if self.profile is None:
+                import cProfile ## the profilers are only imported once used, this module is imported to build the parser
+                self.profile = cProfile.Profile()
+            self.profile.enable()
+        try:
+            yield
+        finally:
+            if profiling:
+                self.profile.disable()
+                self.profiled_ticks += 1
+                self.profile_left -= 1
+                if self.profile_left == 0:
+                    self.write_profile()
+            self.ticks_seen += 1
+            if self.snapshot_requested or (self.memory_interval and self.ticks_seen % self.memory_interval == 0):
+                self.snapshot_requested = False
+                self.write_snapshot()
+
+    def report_path(self, kind):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f'{kind}_{int(time.time())}')
+
+    def write_profile(self):
+        '''
+        Writes the profile of the ticks since start_profile as text (slowest functions, then the hot paths) and in pstats
+        format (for snakeviz, gprof2dot, ...).
+        '''
+        import pstats
+        path = self.report_path('profile')
+        try:
+            self.profile.dump_stats(f'{path}.prof')
+            with open(f'{path}.txt', 'w') as outfile:
+                outfile.write(f'Profile of {self.profiled_ticks} poll ticks\n\n')
+                stats = pstats.Stats(self.profile, stream=outfile).sort_stats('cumulative')
+                stats.print_stats(40)
+                outfile.write('Requests, JSON parsing and Discord updates\n')
+                stats.print_stats(HOT_PATHS)
+        except OSError as e:
+            logging.error(f'Failed to write the profile: {e}')
+        else:
+            logging.info(f'Wrote the profile of {self.profiled_ticks} ticks to {path}.txt.')
+            print(f'Wrote the profile of {self.profiled_ticks} ticks to {path}.txt.')
+        self.profile, self.profiled_ticks = None, 0
+
+    def write_snapshot(self):
+        '''
+        Writes the largest allocations and what grew since the previous snapshot.
+        '''
+        import cProfile
+        import pstats
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEBACK_FRAMES)
+            logging.info('Started tracing memory allocations, the next snapshot is compared with this point.')
+            print('Started tracing memory allocations, the next snapshot is compared with this point.')
+            self.last_snapshot = None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__), ## left over from a profile taken in between
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>')
+        ))
+        if self.last_snapshot is None:
+            self.last_snapshot = snapshot
+            return
+        path = f"{self.report_path('memory')}.txt"
+        current, peak = tracemalloc.get_traced_memory()
+        try:
+            with open(path, 'w') as outfile:
+                outfile.write(f'Traced memory after {self.ticks_seen} ticks: {current / 1024:.1f} KiB (peak {peak / 1024:.1f} KiB)\n\n')
+                outfile.write('Growth since the previous snapshot\n')
+                for stat in snapshot.compare_to(self.last_snapshot, 'lineno')[:TOP_LINES]:
+                    outfile.write(f'{stat}\n')
+                outfile.write('\nLargest allocations\n')
+                for stat in snapshot.statistics('lineno')[:TOP_LINES]:
+                    outfile.write(f'{stat}\n')
+                outfile.write('\nLargest growth, by caller\n')
+                for stat in snapshot.compare_to(self.last_snapshot, 'traceback')[:3]:
+                    outfile.write(f'{stat}\n' + '\n'.join(stat.traceback.format()) + '\n\n')
+        except OSError as e:
+            logging.error(f'Failed to write the memory report: {e}')
+        else:
+            logging.info(f'Wrote the memory report to {path}.')
+            print(f'Wrote the memory report to {path}.')
+        self.last_snapshot = snapshot
+
+def add_arguments(parser):
+    '''
+    Adds the profiling options to the argparse PARSER.
+    '''
+    parser.add_argument('-profile-ticks', type=int, default=0, help=f'Profile the first this many poll ticks and write the report to logs/. SIGUSR1 profiles the next {DEFAULT_TICKS} ticks at any time. Default is off.')
+    parser.add_argument('-trace-memory', type=int, default=0, help='Compare memory snapshots every this many poll ticks and write the reports to logs/. SIGUSR2 takes a snapshot at any time. Default is off.')
+
+def from_args(args):
+    '''
+    Creates a Profiler from the options added by add_arguments, with the signal handlers installed.
+    '''
+    profiler = Profiler(memory_interval=args.trace_memory)
+    if args.profile_ticks:
+        profiler.start_profile(args.profile_ticks)
+    profiler.install_signals()
+    return profiler
@@ -0,0 +1,146 @@
+'''
+Compact records for friends and their presence. The friend list JSON carries many fields nothing here uses and repeats
+the same game names, states and image URLs across friends and polls. Records keep only the fields that are used, intern
+the repeated strings, and are updated in place from each response, so a long-running daemon keeps one record per friend
+instead of a fresh set of dictionaries every poll.
+
+Records can be read like the dictionaries they replace (record['presence']['state'], presence.get('game')), so code
+written against the JSON keeps working.
+'''
+
+import sys
+
+class Record:
+    '''
+    Read-only mapping access to the slots of a record.
+    '''
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        '''
+        Returns the field KEY, or DEFAULT if the record doesn't have it or it is empty (e.g. no game).
+        '''
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def to_dict(self):
+        '''
+        Returns the record as plain dictionaries, in the shape of the JSON it was built from.
+        '''
+        return {key: value.to_dict() if isinstance(value, Record) else value for key, value in ((key, getattr(self, key)) for key in self.__slots__)}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+def intern(value):
+    '''
+    Returns the shared copy of VALUE if it is a string, so repeated strings are only kept once.
+    '''
+    return sys.intern(value) if isinstance(value, str) else value
+
+class GameRecord(Record):
+    '''
+    A game, shared by every friend playing it.
+    '''
+
+    __slots__ = ('name', 'imageUri')
+
+    def __init__(self, name, image_uri):
+        self.name = name
+        self.imageUri = image_uri
+
+_games = {} ## (name, imageUri) -> GameRecord; bounded by the number of games friends have played
+
+def game_record(game):
+    '''
+    Returns the GameRecord for the JSON GAME, or None if it is empty (not playing anything).
+    '''
+    if not game:
+        return None
+    key = (game.get('name'), game.get('imageUri'))
+    record = _games.get(key)
+    if record is None:
+        record = _games[key] = GameRecord(intern(key[0]), intern(key[1]))
+    return record
+
+class PresenceRecord(Record):
+    '''
+    A friend's presence. Never changed once created: a new one replaces it when the presence changes, so a reader on
+    another thread always sees a consistent state and game.
+    '''
+
+    __slots__ = ('state', 'updatedAt', 'logoutAt', 'game')
+
+    def __init__(self, presence):
+        self.state = intern(presence['state'])
+        self.updatedAt = presence.get('updatedAt', 0)
+        self.logoutAt = presence.get('logoutAt', 0)
+        self.game = game_record(presence.get('game'))
+
+    def matches(self, presence):
+        '''
+        Returns whether the JSON PRESENCE is the same as this record.
+        '''
+        game = presence.get('game') or {}
+        return (
+            self.state == presence['state'] and self.updatedAt == presence.get('updatedAt', 0) and self.logoutAt == presence.get('logoutAt', 0)
+            and (self.game.name if self.game else None) == game.get('name') and (self.game.imageUri if self.game else None) == game.get('imageUri')
+        )
+
+class FriendRecord(Record):
+    '''
+    A friend (or the User themselves), built from an entry of the friend list or the user of the login response.
+    '''
+
+    __slots__ = ('id', 'nsaId', 'name', 'imageUri', 'presence')
+
+    def __init__(self, friend):
+        self.id = friend['id']
+        self.nsaId = friend['nsaId']
+        self.name = intern(friend['name'])
+        self.imageUri = intern(friend['imageUri'])
+        self.presence = PresenceRecord(friend['presence'])
+
+    def update(self, friend):
+        '''
+        Updates this record in place from the JSON FRIEND. Nothing is allocated unless something changed.
+        '''
+        if friend['name'] != self.name:
+            self.name = intern(friend['name'])
+        if friend['imageUri'] != self.imageUri:
+            self.imageUri = intern(friend['imageUri'])
+        if not self.presence.matches(friend['presence']):
+            self.presence = PresenceRecord(friend['presence'])
+        return self
+
+class FriendTable:
+    '''
+    FriendRecords by nsaId, updated in place from each friend list.
+    '''
+
+    def __init__(self):
+        self.records = {}
+
+    def update(self, friends):
+        '''
+        Returns the records for the JSON FRIENDS, in the same order. Records of friends no longer in the list are dropped.
+        '''
+        updated = []
+        for friend in friends:
+            record = self.records.get(friend['nsaId'])
+            if record is None:
+                record = self.records[friend['nsaId']] = FriendRecord(friend)
+            else:
+                record.update(friend)
+            updated.append(record)
+        if len(self.records) != len(updated): ## someone was unfriended
+            current = {record.nsaId for record in updated}
+            for nsa_id in [nsa_id for nsa_id in self.records if nsa_id not in current]:
+                del self.records[nsa_id]
+        return updated
@@ -0,0 +1,49 @@
+'''
+Background token refresher. Renews a User's credentials well before they expire, from its own thread, so the poll loop
+keeps using the current (still valid) credentials and never stalls on the multi-request re-auth chain. The inline checks
+in User.refresh_login remain as a fallback, and only fire if the background refresh kept failing until the very end.
+'''
+
+import logging
+import threading
+import backoff
+import credentials
+import metrics
+
+CHECK_INTERVAL = 30 ## seconds between expiry checks
+
+class TokenRefresher:
+    '''
+    Keeps USER logged in, renewing its credentials MARGIN seconds before they expire. Failed refreshes are retried with
+    backoff; the current credentials keep being served meanwhile.
+    '''
+
+    def __init__(self, user, margin=credentials.PROACTIVE_MARGIN, interval=CHECK_INTERVAL):
+        self.user = user
+        self.margin = margin
+        self.interval = interval
+        self.failures = backoff.Backoff(base=5, cap=interval)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=f'refresher-{self.user.get_name()}', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            delay = self.interval
+            try:
+                if self.user.refresh_login(self.margin):
+                    metrics.inc('background_refreshes_total', result='ok')
+                self.failures.reset()
+            except Exception as e: ## the thread must outlive any failure, the poll loop still has valid credentials
+                delay = self.failures.next_delay()
+                metrics.inc('background_refreshes_total', result='failed')
+                logging.error(f'Background login refresh for {self.user.get_name()} failed ({e!r}), retrying in {delay:.0f} seconds.')
+            self.stopped.wait(delay)
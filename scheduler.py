@@ -0,0 +1,63 @@
+'''
+Chooses when to poll the friend list next, based on the displayed user's presence and how recently it changed.
+'''
+
+import random
+import time
+
+class PollScheduler:
+    '''
+    Polls every MIN_INTERVAL seconds for BURST_POLLS polls after the displayed user's state or game changes,
+    every BASE_INTERVAL seconds while they are online, and backs off towards MAX_INTERVAL the longer they have been
+    offline. Every delay is spread by up to JITTER (a fraction) so that many watchers don't poll in lockstep.
+    '''
+
+    def __init__(self, min_interval=15, base_interval=30, max_interval=300, jitter=0.1, burst_polls=4):
+        self.min_interval = min_interval
+        self.base_interval = max(base_interval, min_interval)
+        self.max_interval = max(max_interval, self.base_interval)
+        self.jitter = jitter
+        self.burst_polls = burst_polls
+        self.last_key = None ## (state, game name) seen on the previous poll
+        self.burst_left = 0
+
+    def next_delay(self, displayed_user_status, now=None):
+        '''
+        Returns the number of seconds to wait before the next poll, given the latest DISPLAYED_USER_STATUS.
+        '''
+        now = time.time() if now is None else now
+        presence = displayed_user_status['presence']
+        state = presence['state']
+        key = (state, (presence.get('game') or {}).get('name'))
+
+        if self.last_key is not None and key != self.last_key: ## just switched state or game, more changes tend to follow
+            self.burst_left = self.burst_polls
+        self.last_key = key
+
+        if self.burst_left > 0:
+            self.burst_left -= 1
+            delay = self.min_interval
+        elif now - presence.get('updatedAt', 0) < self.base_interval: ## Nintendo saw a change we may only have caught the end of
+            delay = self.min_interval
+        elif state == 'OFFLINE':
+            offline_since = presence.get('logoutAt') or presence.get('updatedAt') or now
+            delay = min(self.max_interval, max(self.base_interval, (now - offline_since) / 10)) ## offline for an hour -> poll every six minutes
+        else:
+            delay = self.base_interval
+
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+def add_arguments(parser):
+    '''
+    Adds the options configuring a PollScheduler to the argparse PARSER.
+    '''
+    parser.add_argument('-min-interval', type=float, default=15, help='Seconds between polls right after the displayed user changes state or game. Default is 15.')
+    parser.add_argument('-interval', type=float, default=30, help='Seconds between polls while the displayed user is online. Default is 30.')
+    parser.add_argument('-max-interval', type=float, default=300, help='Longest time between polls while the displayed user is offline. Default is 300.')
+    parser.add_argument('-jitter', type=float, default=0.1, help='Fraction by which each delay is randomly spread. Default is 0.1.')
+
+def from_args(args):
+    '''
+    Creates a PollScheduler from the options added by add_arguments.
+    '''
+    return PollScheduler(args.min_interval, args.interval, args.max_interval, args.jitter)
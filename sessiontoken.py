@@ -4,12 +4,12 @@ proceed with further registration.
 '''
 
 import base64
-import requests
 import webbrowser
 import re
 import secrets
 import hashlib
 import errors
+import transport
 
 def get_token():
     client_id = '71b963c1b7b6d119'
@@ -39,7 +39,8 @@ def get_token():
         'state': rand,
         'theme': 'login_form'
     }
-    link_url = requests.get(session_token_code_url, params=params, headers=headers).url
+    session = transport.get_session()
+    link_url = session.get(session_token_code_url, params=params, headers=headers, timeout=transport.TIMEOUT).url
     webbrowser.open(link_url)
 
     link = input('Right click "Select this account" and paste the link here: ')
@@ -49,7 +50,7 @@ def get_token():
         'session_token_code': session_token_code,
         'session_token_code_verifier': verifier
     }
-    response = requests.post(session_token_url, data=data, headers=headers).json()
+    response = session.post(session_token_url, data=data, headers=headers, timeout=transport.TIMEOUT).json()
     try:
         response['session_token']
     except KeyError:
@@ -0,0 +1,84 @@
+'''
+Shared, pooled HTTP session used for every request to Nintendo, imink and the App Store, so that connections
+(and their TLS handshakes) are reused between polls instead of being opened for every request.
+'''
+
+import threading
+import urllib.parse
+import backoff
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+POOL_CONNECTIONS = 8 ## number of hosts to keep connection pools for
+POOL_MAXSIZE = 4 ## connections kept open per host
+TIMEOUT = (5, 20) ## seconds to connect, seconds to wait for a response
+
+_session = None
+_lock = threading.Lock()
+_breakers = {} ## host -> CircuitBreaker
+
+def make_retry():
+    '''
+    Returns the retry policy: connection failures are retried with exponential backoff, and so are throttling
+    and gateway errors. Reads are only retried once since a POST may already have been processed.
+    '''
+    return urllib3.util.retry.Retry(
+        total=3,
+        connect=3,
+        read=1,
+        status=2,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'POST']),
+        raise_on_status=False,
+        respect_retry_after_header=True
+    )
+
+def make_session():
+    '''
+    Creates a new session with a bounded connection pool per host.
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        pool_block=True, ## wait for a free connection instead of going over the per-host limit
+        max_retries=make_retry()
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate' ## responses are decompressed transparently
+    return session
+
+def get_session():
+    '''
+    Returns the session shared by the whole process, creating it on first use.
+    '''
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = make_session()
+    return _session
+
+def get_breaker(url):
+    '''
+    Returns the circuit breaker for the host of URL. Once a host keeps failing, requests to it fail fast for a while
+    instead of each one waiting for timeouts and retries.
+    '''
+    host = urllib.parse.urlsplit(url).netloc
+    with _lock:
+        if host not in _breakers:
+            _breakers[host] = backoff.CircuitBreaker()
+        return _breakers[host]
+
+def close():
+    '''
+    Closes every pooled connection. The next call to get_session creates a fresh session.
+    '''
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
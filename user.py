@@ -1,9 +1,20 @@
+import asyncio
 import requests
+import threading
 import time
 import logging
 import errors
-import datetime
-import itunes_app_scraper.scraper
+import urllib.parse
+import appversion
+import credentials
+import transport
+import friendindex
+import metrics
+import logutil
+import events
+import records
+import pipeline
+import ftoken
 
 class User:
     '''
@@ -14,18 +25,102 @@ class User:
     gen_info_url = 'https://accounts.nintendo.com/2.0.0/users/me'
     login_url = 'https://api-lp1.znc.srv.nintendo.net/v3/Account/Login'
     friends_list_url = 'https://api-lp1.znc.srv.nintendo.net/v3/Friend/List'
-    imink_url = 'https://api.imink.app/f'
     version = '1.0'
+    birthday_lifetime = 30 * 86400 ## the birthday practically never changes, so it is only looked up again once a month
 
     def __init__(self, session_token):
         self.client_id = '71b963c1b7b6d119' ## magic number
         self.session_token = session_token
         self.logging = False ## logging default off
         self.version = str(User.version) ## needed for right version check
+        self.credentials = credentials.CredentialManager() ## tracks when each token expires
 
-    def get_access_id_token(self):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'credentials' not in state: ## pickled before credentials were tracked
+            self.credentials = credentials.CredentialManager()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_session', None) ## connections are per-process and can't be serialized
+        state.pop('_login_lock', None)
+        state.pop('_friend_index', None) ## rebuilt from the next friend list
+        state.pop('on_login', None)
+        state.pop('_presence_stream', None) ## subscribers are callbacks of this process
+        state.pop('_friend_records', None) ## rebuilt from the next friend list
+        state.pop('_status_record', None)
+        state.pop('friends_list', None)
+        state.pop('last_events', None) ## events hold FriendRecords, which would tie saved users to their class layout
+        state.pop('login_timings', None)
+        return state
+
+    @property
+    def session(self):
+        '''
+        The pooled HTTP session this User makes its requests with. Shared across the process by default.
+        '''
+        if self.__dict__.get('_session') is None:
+            self._session = transport.get_session()
+        return self._session
+
+    @property
+    def login_lock(self):
+        '''
+        Lock held while logging in again, so that concurrent callers don't refresh the same credentials twice.
+        '''
+        if self.__dict__.get('_login_lock') is None:
+            self._login_lock = threading.Lock()
+        return self._login_lock
+
+    @property
+    def friend_index(self):
+        '''
+        Index over this User's friends (and this User), updated by get_all_status.
+        '''
+        if self.__dict__.get('_friend_index') is None:
+            self._friend_index = friendindex.FriendIndex()
+        return self._friend_index
+
+    @property
+    def friend_records(self):
+        '''
+        This User's friends as FriendRecords (see records.py), updated in place by get_friends_list.
+        '''
+        if self.__dict__.get('_friend_records') is None:
+            self._friend_records = records.FriendTable()
+        return self._friend_records
+
+    @property
+    def presence_stream(self):
+        '''
+        Presence change events of this User's friends, updated by get_all_status.
+        '''
+        if self.__dict__.get('_presence_stream') is None:
+            self._presence_stream = events.PresenceStream()
+        return self._presence_stream
+
+    def subscribe(self, callback, users=None):
+        '''
+        Calls CALLBACK with a PresenceEvent (see events.py) whenever a friend goes online or offline, changes game, name
+        or icon. USERS limits this to specific friends (names, nsaIds or ids). Events are produced by whichever call
+        fetches the friend list (get_all_status, get_account_status), so one poll serves every subscriber.
+        Returns a function that unsubscribes again.
+        '''
+        return self.presence_stream.subscribe(callback, users)
+
+    def poll_events(self):
+        '''
+        Fetches the friend list once and returns the presence events since the previous fetch.
+        '''
+        self.get_all_status()
+        return self.last_events
+
+    @metrics.count_failures('access_id_token')
+    def get_access_id_token(self, prefetch_f=True):
         '''
         Makes a POST request to token_url and returns a dictionary containing the access_token and id_token which is necessary for future login attempts.
+        With PREFETCH_F, the f parameter for the new id_token starts being generated right away; only ask for it when a
+        login will use it, since the f API receives the id_token.
         '''
         token_headers = {
             'Host': 'accounts.nintendo.com',
@@ -47,7 +142,15 @@ class User:
         except KeyError:
             logging.error('Invalid response received. See above response details.')
             raise errors.InvalidAPIResponse()
+        expires_in = access_id_response.get('expires_in', 900)
+        self.credentials.set('access_token', self.access_token, expires_in)
+        self.credentials.set('id_token', self.id_token, expires_in)
+        self.credentials.invalidate('f') ## the f parameter belongs to the previous id_token
+        if prefetch_f:
+            ftoken.get_pool().prefetch(self.id_token, self.get_request) ## ready by the time get_imink asks for it
+        metrics.inc('refreshes_total', step='access_id_token')
     
+    @metrics.count_failures('birthday')
     def get_birthday(self):
         '''
         Makes a GET request to gen_info_url and returns a dictionary containing the User's birthday which is necessary for future login attempts.
@@ -67,26 +170,21 @@ class User:
         except KeyError:
             logging.error('Invalid response received. See above response details.')
             raise errors.InvalidAPIResponse()
+        self.credentials.set('birthday', self.birthday, User.birthday_lifetime)
+        metrics.inc('refreshes_total', step='birthday')
 
+    @metrics.count_failures('imink')
     def get_imink(self):
         '''
-        Makes a POST request to imink_url and returns a dictionary containing the User's f parameter, request_id, and timestamp, all necessary for logging in.
+        Gets the User's f parameter, request_id, and timestamp, all necessary for logging in, from the f parameter providers
+        (see ftoken.py). Usually they were already prefetched when the id_token was issued.
         '''
-        imink_headers = {
-            'User-Agent': 'DiscordRPC4Switch/1.0',
-            'Content-Type': 'application/json; charset=utf-8'
-        }
-        imink_json = {
-            'token': self.id_token,
-            'hash_method': 1
-        }
-        imink_response = self.get_request('post', User.imink_url, headers=imink_headers, json=imink_json)
-        try:
-            self.f, self.request_id, self.timestamp = imink_response['f'], imink_response['request_id'], imink_response['timestamp']
-        except KeyError:
-            logging.error('Invalid response received. See above response details.')
-            raise errors.InvalidAPIResponse()
+        self.f, self.request_id, self.timestamp = ftoken.get_pool().generate(self.id_token, self.get_request)
+        lifetime = min(self.credentials.credentials['id_token'].seconds_left(), ftoken.PREFETCH_MAX_AGE) ## the login server rejects old timestamps
+        self.credentials.set('f', (self.f, self.request_id, self.timestamp), lifetime)
+        metrics.inc('refreshes_total', step='imink')
     
+    @metrics.count_failures('login')
     def get_login(self):
         '''
         Performs a login for the User by making a POST request to the login server. Returns a dictionary in the following format:
@@ -136,18 +234,13 @@ class User:
         }
         Mostly interested in just the User's name, icon (for displaying to Discord), status (also for displaying to discord), and webApiServerCredential (needed to get friend status)
         '''
-        current_time = time.time() ## used to figure out when to refresh
-        if current_time - self.start_time_access_id > 800: ## refresh access_token and f parameter every 10 minutes
+        if self.credentials.expires_soon('id_token'): ## the f parameter is generated from the id_token, so both are renewed together
             self.get_access_id_token()
             self.get_imink()
-            self.start_time_access_id = current_time
-
-        ITUNES_APP_ID = 1234806557
+        elif self.credentials.expires_soon('f'):
+            self.get_imink()
 
-        scraper = itunes_app_scraper.scraper.AppStoreScraper()
-        nso_app_info = scraper.get_app_details(ITUNES_APP_ID, country = 'us')
-        nsoAppVersion = nso_app_info.get('version')
-        
+        nsoAppVersion = appversion.get_version() ## cached, only hits the App Store once the cache is stale
 
         login_headers = {
             'Host': 'api-lp1.znc.srv.nintendo.net',
@@ -172,24 +265,79 @@ class User:
                 "f": self.f
             } 
         }
-        login_response = self.get_request('post', User.login_url, headers=login_headers, json=login_json)
         try:
-            self.webApiServerCredential = login_response['result']['webApiServerCredential']['accessToken'] ## expires every 15 minutes
-            self.name, self.icon, self.status = login_response['result']['user']['name'], login_response['result']['user']['imageUri'], login_response['result']['user']
-        except KeyError:
-            logging.error('Invalid response received. See above response details.')
-            raise errors.InvalidAPIResponse()
+            login_response = self.get_request('post', User.login_url, headers=login_headers, json=login_json)
+            try:
+                web_api_server_credential = login_response['result']['webApiServerCredential']['accessToken']
+                web_api_expires_in = login_response['result']['webApiServerCredential'].get('expiresIn', 7200)
+                name, icon, status = login_response['result']['user']['name'], login_response['result']['user']['imageUri'], login_response['result']['user']
+            except KeyError:
+                logging.error('Invalid response received. See above response details.')
+                raise errors.InvalidAPIResponse()
+        except errors.InvalidAPIResponse:
+            self.credentials.invalidate('f') ## possibly what was rejected, the next attempt generates a new one
+            raise
+        ## swapped in only once the whole response is valid; a concurrent poll sees either the old or the new credential
+        self.name, self.icon, self.status = name, icon, status
+        self.webApiServerCredential = web_api_server_credential
+        self.credentials.set('webApiServerCredential', self.webApiServerCredential, web_api_expires_in)
+        metrics.inc('refreshes_total', step='login')
+        self.save_credentials()
+
+    def save_credentials(self):
+        '''
+        Calls the on_login hook (if set, e.g. to save this User to the account store) so that refreshed tokens survive a restart.
+        '''
+        on_login = self.__dict__.get('on_login')
+        if on_login is not None:
+            on_login(self)
+
+    def refresh_login(self, margin=credentials.REFRESH_MARGIN):
+        '''
+        Logs in again only if the webApiServerCredential expires within MARGIN seconds. Returns whether a login was performed.
+        The current credentials stay in use until the new ones are swapped in, so callers with a smaller margin don't wait
+        for a refresh started early by another thread (see refresher.py).
+        '''
+        if not self.credentials.expires_soon('webApiServerCredential', margin):
+            return False
+        with self.login_lock:
+            if not self.credentials.expires_soon('webApiServerCredential', margin): ## another thread got here first
+                return False
+            logging.info('webApiServerCredential is about to expire, refreshing login...')
+            self.get_login()
+        return True
 
     def login(self):
         '''
         Performs all the logging-in procedures all in one place. Need to separate each function because when refreshing, we don't need to perform every single step again, just some specific ones.
+        Steps whose results are still valid (e.g. when this User was saved after a recent login) are skipped, and so are
+        the tokens and the f parameter when no step needs them.
+        Steps that don't depend on each other run concurrently: the birthday and the f parameter both only need the tokens,
+        and the NSO app version needs nothing. How long each step took is kept in login_timings.
         '''
-        self.start_time_access_id = time.time()
-        self.start_time_webApi = time.time()
-        self.get_access_id_token()
-        self.get_birthday()
-        self.get_imink()
-        self.get_login()
+        steps = []
+        tokens = ()
+        needs_login = self.credentials.expires_soon('webApiServerCredential')
+        needs_birthday = self.credentials.expires_soon('birthday')
+        if (needs_login and (self.credentials.expires_soon('access_token') or self.credentials.expires_soon('id_token'))) or (needs_birthday and self.credentials.expires_soon('access_token')):
+            steps.append(('access_id_token', lambda: self.get_access_id_token(prefetch_f=needs_login), ())) ## the birthday alone needs no f parameter
+            tokens = ('access_id_token',)
+        if needs_birthday:
+            steps.append(('birthday', self.get_birthday, tokens))
+        if needs_login and (tokens or self.credentials.expires_soon('f')): ## new tokens always need a new f parameter
+            steps.append(('imink', self.get_imink, tokens))
+        if needs_login:
+            steps.append(('app_version', appversion.get_version, ())) ## warms the cache get_login reads from
+            steps.append(('login', self.get_login, tuple(name for name, _, _ in steps)))
+
+        start = time.perf_counter()
+        self.login_timings = pipeline.run(steps)
+        for step, seconds in self.login_timings.items():
+            metrics.observe('login_step_seconds', seconds, step=step)
+        if steps:
+            logging.info('Logged in in %.3f seconds (%s).', time.perf_counter() - start, ', '.join(f'{step} {seconds:.3f}' for step, seconds in self.login_timings.items()))
+        if 'login' not in self.login_timings:
+            self.save_credentials() ## get_login saves otherwise, but earlier steps may still have run
     
     def get_request(self, type, url, headers={}, json={}):
         '''
@@ -197,26 +345,51 @@ class User:
         Returns the response as a dictionary.
         '''
         request = None
-        logging.info(f'Making a {type.upper()} request to {url} with headers {headers} and json {json}')
+        if self.logging: ## bodies are only formatted (redacted and size-capped) if the record is actually written
+            logging.info('Making a %s request to %s with headers %s and json %s', type.upper(), url, logutil.Lazy(headers), logutil.Lazy(json))
+        endpoint = urllib.parse.urlsplit(url).path
+        breaker = transport.get_breaker(url)
+        if not breaker.allow():
+            logging.error(f'Not connecting to {url}, it failed too often recently (retrying in {breaker.seconds_until_retry():.0f} seconds).')
+            metrics.inc('requests_total', endpoint=endpoint, status='circuit_open')
+            raise errors.ConnectionError()
+        start = time.perf_counter()
         
         try:
             if type == 'post':
-                request = requests.post(url, headers=headers, json=json)
+                request = self.session.post(url, headers=headers, json=json, timeout=transport.TIMEOUT)
             elif type == 'get':
-                request = requests.get(url, headers=headers, json=json)
-        except requests.exceptions.ConnectionError:
-            logging.error(f'Connection to {url} failed.')
+                request = self.session.get(url, headers=headers, json=json, timeout=transport.TIMEOUT)
+        except requests.exceptions.RequestException as e: ## also broken or undecodable bodies and redirect loops, which would otherwise leave a half-open breaker's trial running forever
+            logging.error(f'Connection to {url} failed ({e.__class__.__name__}).')
+            breaker.record_failure()
+            metrics.inc('requests_total', endpoint=endpoint, status='connection_error')
             raise errors.ConnectionError() from None
 
-        time = datetime.datetime.now()
+        if request.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
 
-        logging.info(f'Received the following response: {request.json()}')
+        metrics.observe('request_seconds', time.perf_counter() - start, endpoint=endpoint)
+        metrics.inc('requests_total', endpoint=endpoint, status=request.status_code)
 
-        return request.json()
+        try:
+            response = request.json() ## parsed once, for the log and the caller
+        except ValueError: ## e.g. an HTML error page from a gateway, or what's left after the 429/5xx retries ran out
+            logging.error(f'Received a response that is not JSON from {url} (status {request.status_code}): {request.text[:200]!r}')
+            breaker.record_failure()
+            raise errors.InvalidAPIResponse() from None
+        if self.logging:
+            logging.info('Received the following response: %s', logutil.Lazy(response))
+
+        return response
 
+    @metrics.count_failures('friends_list')
     def get_friends_list(self):
         '''
-        Returns the Friends List as a list of dictionaries, each dictionary storing relevant information for each friend.
+        Returns the Friends List as a list of FriendRecords, each storing relevant information for each friend. The records
+        are the same objects from one call to the next, updated in place, and can be read like the response's dictionaries.
 
         Format of response (this is just one friend):
         [{
@@ -236,10 +409,7 @@ class User:
             }
         }]
         '''
-        current_time = time.time() ## used to figure out when to refresh
-        if current_time - self.start_time_webApi > 5400: ## refresh login every hour and thirty minutes
-            self.get_login() ## refresh webApiServerCredential every 2 hours
-            self.start_time_webApi = current_time
+        self.refresh_login() ## only logs in again when the webApiServerCredential is about to expire
         friends_headers = {
             'Host':'api-lp1.znc.srv.nintendo.net',
             'Accept':'application/json',
@@ -249,7 +419,12 @@ class User:
             'Authorization': 'Bearer ' + self.webApiServerCredential 
         } 
         friends_response = self.get_request('post', self.friends_list_url, headers=friends_headers)
-        self.friends_list = friends_response['result']['friends']
+        try:
+            self.friends_list = self.friend_records.update(friends_response['result']['friends'])
+        except (KeyError, TypeError):
+            logging.error('Invalid response received. See above response details.')
+            self.credentials.invalidate('webApiServerCredential') ## most often an expired token, so log in again next time
+            raise errors.InvalidAPIResponse()
         return self.friends_list
 
     def get_name(self):
@@ -261,32 +436,84 @@ class User:
     def get_status(self):
         '''
         Returns this User's status (currently broken because of changes to NSO API, always reports status as offline).
+        The status is the one received with the last login, which is renewed along with the webApiServerCredential.
         '''
-        self.get_login()
+        self.refresh_login()
         return self.status
+
+    def get_status_record(self):
+        '''
+        Returns this User's status as a FriendRecord, updated in place like the friends' records.
+        '''
+        status = self.get_status()
+        record = self.__dict__.get('_status_record')
+        if record is None or record.nsaId != status['nsaId']:
+            self._status_record = record = records.FriendRecord(status)
+        else:
+            record.update(status)
+        return record
     
-    def get_account_status(self, account_name):
+    def get_account_status(self, account_name, fetch=True):
         '''
-        Returns the status of a specific friend (specified in ACCOUNT_NAME) as a dictionary.
+        Returns the status of a specific friend (specified in ACCOUNT_NAME, which may also be an nsaId or id) as a FriendRecord,
+        or None if there is no such friend. Unless FETCH is False, the friend list is fetched again first.
+        A friend found once is followed by nsaId afterwards, so they are still found after a name change.
         '''
-        friends_list = self.get_all_status()
-        for friend in friends_list:
-            if friend['name'] == account_name:
-                return friend
-        return None
+        if fetch:
+            self.get_all_status()
+        return self.friend_index.find(account_name)
     
     def get_all_status(self):
         '''
-        Returns the status of this User and this User's friends as a list of dictionaries. 
+        Returns the status of this User and this User's friends as a list of FriendRecords.
         '''
-        friends = self.get_friends_list()[:]
-        user = self.get_status()
-        friends.append(user)
+        friends = self.get_friends_list() + [self.get_status_record()]
+        self.friend_index.update(friends)
+        self.last_events = self.presence_stream.update(friends, self.friend_index.find)
         return friends
     
-    def toggle_log(self):
+    def toggle_log(self, enabled=True):
+        '''
+        Turns logging of request and response bodies on or off (bodies are redacted and size-capped either way).
+        '''
+        self.logging = enabled
+
+    ## asyncio versions of the calls above. requests is blocking, so each one runs in a worker thread
+    ## (sharing the pooled session) and the event loop stays free while waiting on Nintendo.
+
+    async def get_request_async(self, type, url, headers={}, json={}):
+        '''
+        Same as get_request, but awaitable.
+        '''
+        return await asyncio.to_thread(self.get_request, type, url, headers, json)
+
+    async def refresh_login_async(self, margin=credentials.REFRESH_MARGIN):
+        '''
+        Same as refresh_login, but awaitable.
+        '''
+        return await asyncio.to_thread(self.refresh_login, margin)
+
+    async def get_friends_list_async(self):
+        '''
+        Same as get_friends_list, but awaitable.
+        '''
+        return await asyncio.to_thread(self.get_friends_list)
+
+    async def get_account_status_async(self, account_name, fetch=True):
+        '''
+        Same as get_account_status, but awaitable.
+        '''
+        return await asyncio.to_thread(self.get_account_status, account_name, fetch)
+
+    async def events(self, interval=30, users=None):
         '''
-        Toggles the log feature.
+        Async iterator over presence events, fetching the friend list every INTERVAL seconds.
+        USERS limits the events to specific friends, like subscribe.
         '''
-        self.logging = True
-        logging.getLogger(__name__)
\ No newline at end of file
+        while True:
+            await asyncio.to_thread(self.get_all_status)
+            wanted = None if users is None else {friend['nsaId'] for friend in map(self.friend_index.find, users) if friend is not None}
+            for event in self.last_events:
+                if wanted is None or event.nsa_id in wanted:
+                    yield event
+            await asyncio.sleep(interval)